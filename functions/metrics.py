@@ -1,9 +1,226 @@
 import geopandas as gpd
 import numpy as np
 import pandas as pd
+import shapely
+from joblib import Parallel, delayed
 
 
-def get_fractional_sets(dets_gdf, labels_gdf, iou_threshold=0.25, area_threshold=None):
+def get_best_labels(candidates_df, iou_threshold=0.25):
+    """Pair each detection with the label of highest IoU, the smallest label_id breaking ties, and keep the pairs over the IoU threshold.
+
+    Args:
+        candidates_df (dataframe): pairs of detection and label ids with their IoU, as returned by get_candidate_pairs.
+        iou_threshold (float): threshold to apply on the IoU to determine if detections and labels can be matched. Defaults to 0.25.
+
+    Returns:
+        dataframe: pairs of detection and label ids with their IoU, at most one per detection.
+    """
+
+    best_matches_df = candidates_df.sort_values(by=['det_id', 'IOU', 'label_id'], ascending=[True, False, True], kind='stable')
+    best_matches_df = best_matches_df.drop_duplicates(subset=['det_id'])
+
+    return best_matches_df[best_matches_df['IOU'] >= iou_threshold]
+
+
+def get_bootstrap_intervals(tagged_df, id_classes=0, group_name='tile_id', nb_resamples=1000, confidence_level=0.95, method='macro-average', n_jobs=1, seed=None):
+    """Estimate confidence intervals for the metrics by resampling the groups, e.g. the tiles, with replacement.
+    The tagged detections are counted once by group and each resample is a weighted sum of these counts, so no geometry is involved.
+
+    Args:
+        tagged_df (dataframe): tagged detections and labels with the columns 'tag', 'det_class', 'label_class' and the group column
+        id_classes (list): list of the possible class ids. Defaults to 0.
+        group_name (str): name of the column with the group of each row. Defaults to 'tile_id'.
+        nb_resamples (int): number of bootstrap resamples. Defaults to 1000.
+        confidence_level (float): level of the confidence intervals. Defaults to 0.95.
+        method (str): method used to compute multi-class metrics. Defaults to 'macro-average'.
+        n_jobs (int): number of processes sharing the chunks of resamples. Defaults to 1.
+        seed (int): seed of the random generator. Defaults to None.
+
+    Returns:
+        dataframe: value on the whole dataset, mean, standard deviation and bounds of the confidence interval for the accuracy, precision, recall and f1 score.
+    """
+
+    _, tp_by_group, fp_by_group, fn_by_group = get_counts_by_group(tagged_df, id_classes, group_name)
+    _, _, _, *metrics_values = get_metrics_from_counts(tp_by_group.sum(axis=0), fp_by_group.sum(axis=0), fn_by_group.sum(axis=0), method)
+
+    # One independent random stream per chunk of 100 resamples, so that the intervals do not depend on the number of jobs
+    chunk_starts = np.arange(0, max(nb_resamples, 1), 100)
+    chunk_sizes = np.diff(np.append(chunk_starts, nb_resamples))
+    nb_chunks = len(chunk_sizes)
+    seeds = np.random.SeedSequence(seed).spawn(nb_chunks)
+    resamples_list = Parallel(n_jobs=n_jobs)(
+        delayed(get_bootstrap_resamples)(tp_by_group, fp_by_group, fn_by_group, chunk_size, method, chunk_seed)
+        for chunk_size, chunk_seed in zip(chunk_sizes, seeds)
+    )
+    resamples = np.concatenate(resamples_list, axis=0)
+
+    alpha = (1 - confidence_level) / 2
+    intervals_df = pd.DataFrame({
+        'metric': ['accuracy', 'precision', 'recall', 'f1'],
+        'value': [float(value) for value in metrics_values],
+        'mean': np.nanmean(resamples, axis=0),
+        'std': np.nanstd(resamples, axis=0),
+        'lower_bound': np.nanquantile(resamples, alpha, axis=0),
+        'upper_bound': np.nanquantile(resamples, 1 - alpha, axis=0),
+    })
+    intervals_df['confidence_level'] = confidence_level
+    intervals_df['nb_resamples'] = nb_resamples
+    intervals_df['nb_groups'] = tp_by_group.shape[0]
+
+    return intervals_df
+
+
+def get_bootstrap_resamples(tp_by_group, fp_by_group, fn_by_group, nb_resamples, method='macro-average', seed=None):
+    """Compute the metrics of bootstrap resamples of the groups in one matrix product.
+    The weights of the groups in each resample are drawn from a multinomial distribution.
+
+    Args:
+        tp_by_group (array): TP count for each group and class
+        fp_by_group (array): FP count for each group and class
+        fn_by_group (array): FN count for each group and class
+        nb_resamples (int): number of resamples
+        method (str): method used to compute multi-class metrics. Defaults to 'macro-average'.
+        seed (int or SeedSequence): seed of the random generator. Defaults to None.
+
+    Returns:
+        array: accuracy, precision, recall and f1 score of each resample
+    """
+
+    rng = np.random.default_rng(seed)
+    nb_groups = tp_by_group.shape[0]
+    weights = rng.multinomial(nb_groups, np.full(nb_groups, 1 / nb_groups), size=nb_resamples)
+
+    _, _, _, *metrics_values = get_metrics_from_counts(weights @ tp_by_group, weights @ fp_by_group, weights @ fn_by_group, method)
+
+    return np.stack(metrics_values, axis=-1)
+
+
+def get_candidate_pairs(dets_gdf, labels_gdf, min_iou=None):
+    """Find the pairs of intersecting detections and labels with one STRtree query and compute their IoU.
+    When labels and detections have a year, only the pairs from the same year are kept.
+
+    Args:
+        dets_gdf (geodataframe): geodataframe of the detections with a 'det_id' column.
+        labels_gdf (geodataframe): geodataframe of the labels with a 'label_id' column.
+        min_iou (float): if provided, the IoU of the pairs that cannot reach this value given their bounding boxes is not computed and set to 0. Defaults to None.
+
+    Returns:
+        dataframe: pairs of detection and label ids with their IoU.
+    """
+
+    det_geoms = dets_gdf.geometry.to_numpy()
+    label_geoms = labels_gdf.geometry.to_numpy()
+    det_idx, label_idx = shapely.STRtree(label_geoms).query(det_geoms, predicate='intersects')
+
+    # Keep only matching years
+    if 'year_label' in labels_gdf.keys():
+        same_year = labels_gdf.year_label.astype(int).to_numpy()[label_idx] == dets_gdf.year_det.astype(int).to_numpy()[det_idx]
+        det_idx = det_idx[same_year]
+        label_idx = label_idx[same_year]
+
+    candidates_df = pd.DataFrame({
+        'det_id': dets_gdf.det_id.to_numpy()[det_idx],
+        'label_id': labels_gdf.label_id.to_numpy()[label_idx],
+        'IOU': vectorized_intersection_over_union(det_geoms[det_idx], label_geoms[label_idx], min_iou)
+    })
+
+    return candidates_df
+
+
+def get_confusion_matrix(tp_gdf, fp_gdf, fn_gdf, mismatch_gdf, id_classes=0):
+    """Count the detections and labels by pair of label and detection classes in one bincount pass.
+    False positives are counted on the 'background' row and false negatives in the 'background' column.
+    Classes outside of id_classes are counted as background.
+
+    Args:
+        tp_gdf (geodataframe): true positive detections
+        fp_gdf (geodataframe): false positive detections
+        fn_gdf (geodataframe): false negative labels
+        mismatch_gdf (geodataframe): labels and detections intersecting with a mismatched class id
+        id_classes (list): list of the possible class ids. Defaults to 0.
+
+    Returns:
+        dataframe: confusion matrix with the label classes as rows and the detection classes as columns.
+    """
+
+    classes_index = pd.Index(id_classes)
+    nb_classes = len(classes_index)
+
+    def get_class_idx(class_values):
+        class_idx = classes_index.get_indexer(class_values)
+        class_idx[class_idx == -1] = nb_classes
+        return class_idx
+
+    # label classes starting at 1 and detection classes at 0
+    label_idx_list = []
+    det_idx_list = []
+    if not tp_gdf.empty:
+        label_idx_list.append(get_class_idx(tp_gdf.det_class))
+        det_idx_list.append(get_class_idx(tp_gdf.det_class))
+    if not mismatch_gdf.empty:
+        label_idx_list.append(get_class_idx(mismatch_gdf.label_class - 1))
+        det_idx_list.append(get_class_idx(mismatch_gdf.det_class))
+    if not fp_gdf.empty:
+        label_idx_list.append(np.full(len(fp_gdf), nb_classes))
+        det_idx_list.append(get_class_idx(fp_gdf.det_class))
+    if not fn_gdf.empty:
+        label_idx_list.append(get_class_idx(fn_gdf.label_class - 1))
+        det_idx_list.append(np.full(len(fn_gdf), nb_classes))
+
+    label_idx = np.concatenate(label_idx_list).astype(int) if label_idx_list else np.array([], dtype=int)
+    det_idx = np.concatenate(det_idx_list).astype(int) if det_idx_list else np.array([], dtype=int)
+    counts = np.bincount(label_idx * (nb_classes + 1) + det_idx, minlength=(nb_classes + 1)**2).reshape(nb_classes + 1, nb_classes + 1)
+    counts[nb_classes, nb_classes] = 0
+
+    confusion_matrix_df = pd.DataFrame(counts, index=list(id_classes) + ['background'], columns=list(id_classes) + ['background'])
+    confusion_matrix_df.index.name = 'label_class'
+    confusion_matrix_df.columns.name = 'det_class'
+
+    return confusion_matrix_df
+
+
+def get_counts_by_group(tagged_df, id_classes=0, group_name='tile_id'):
+    """Count the TP, FP and FN by group and class with bincount.
+    Mismatched detections, tagged 'wrong class', are FP for the detection class and FN for the label class.
+    The rows without group form a group of their own.
+
+    Args:
+        tagged_df (dataframe): tagged detections and labels with the columns 'tag', 'det_class', 'label_class' and the group column
+        id_classes (list): list of the possible class ids. Defaults to 0.
+        group_name (str): name of the column with the group of each row. Defaults to 'tile_id'.
+
+    Returns:
+        tuple:
+            - array: group values
+            - array: TP count for each group and class
+            - array: FP count for each group and class
+            - array: FN count for each group and class
+    """
+
+    classes_index = pd.Index(id_classes)
+    nb_classes = len(classes_index)
+    group_codes, groups = pd.factorize(tagged_df[group_name], use_na_sentinel=False)
+    nb_groups = len(groups)
+
+    def count_by_group(mask, class_values):
+        class_idx = classes_index.get_indexer(class_values[mask])
+        valid = class_idx != -1
+        return np.bincount(
+            group_codes[mask][valid] * nb_classes + class_idx[valid], minlength=nb_groups * nb_classes
+        ).reshape(nb_groups, nb_classes)
+
+    tags = tagged_df.tag.to_numpy()
+    det_classes = tagged_df.det_class.to_numpy()
+    label_classes = tagged_df.label_class.to_numpy() - 1     # label classes starting at 1 and detection classes at 0
+
+    tp_by_group = count_by_group(tags == 'TP', det_classes)
+    fp_by_group = count_by_group(np.isin(tags, ['FP', 'wrong class']), det_classes)
+    fn_by_group = count_by_group(np.isin(tags, ['FN', 'wrong class']), label_classes)
+
+    return np.asarray(groups), tp_by_group, fp_by_group, fn_by_group
+
+
+def get_fractional_sets(dets_gdf, labels_gdf, iou_threshold=0.25, area_threshold=None, bbox_prefilter=False):
     """
     Find the intersecting detections and labels.
     Control their IoU and class to get the TP.
@@ -15,6 +232,7 @@ def get_fractional_sets(dets_gdf, labels_gdf, iou_threshold=0.25, area_threshold
         labels_gdf (geodataframe): geodataframe of the labels.
         iou_threshold (float): threshold to apply on the IoU to determine if detections and labels can be matched. Defaults to 0.25.
         area_threshold (float): threshold applied on clipped label and detection polygons to discard the smallest ones. Default None
+        bbox_prefilter (bool): skip the IoU computation for the pairs which cannot reach the IoU threshold based on their bounding boxes. Defaults to False.
     Raises:
         Exception: CRS mismatch
 
@@ -27,6 +245,27 @@ def get_fractional_sets(dets_gdf, labels_gdf, iou_threshold=0.25, area_threshold
         - geodataframe: label and detection polygons with an area smaller than the threshold.
         """
 
+    return get_fractional_sets_by_iou(dets_gdf, labels_gdf, [iou_threshold], area_threshold, bbox_prefilter)[iou_threshold]
+
+
+def get_fractional_sets_by_iou(dets_gdf, labels_gdf, iou_thresholds, area_threshold=None, bbox_prefilter=False):
+    """
+    Get the fractional sets of get_fractional_sets for several IoU thresholds.
+    The candidate pairs of detections and labels and their IoU are computed once and reused for each threshold.
+
+    Args:
+        dets_gdf (geodataframe): geodataframe of the detections.
+        labels_gdf (geodataframe): geodataframe of the labels.
+        iou_thresholds (list): thresholds to apply on the IoU to determine if detections and labels can be matched.
+        area_threshold (float): threshold applied on clipped label and detection polygons to discard the smallest ones. Default None
+        bbox_prefilter (bool): skip the IoU computation for the pairs which cannot reach the smallest IoU threshold based on their bounding boxes. Defaults to False.
+    Raises:
+        Exception: CRS mismatch
+
+    Returns:
+        dict: tuple of geodataframes returned by get_fractional_sets for each IoU threshold.
+    """
+
     _dets_gdf = dets_gdf.reset_index(drop=True)
     _labels_gdf = labels_gdf.reset_index(drop=True)
 
@@ -37,93 +276,72 @@ def get_fractional_sets(dets_gdf, labels_gdf, iou_threshold=0.25, area_threshold
         tp_gdf = gpd.GeoDataFrame()
         fn_gdf = gpd.GeoDataFrame()
         mismatched_classes_gdf = gpd.GeoDataFrame()
-        return tp_gdf, fp_gdf, fn_gdf, mismatched_classes_gdf, small_poly_gdf
+        return {iou_threshold: (tp_gdf, fp_gdf, fn_gdf, mismatched_classes_gdf, small_poly_gdf) for iou_threshold in iou_thresholds}
     
     assert(_dets_gdf.crs == _labels_gdf.crs), f"CRS Mismatch: detections' CRS = {_dets_gdf.crs}, labels' CRS = {_labels_gdf.crs}"
 
-    # we add a id column to the labels dataset, which should not exist in detections too;
-    # this allows us to distinguish matching from non-matching detections
-    _labels_gdf['label_id'] = _labels_gdf.index.astype(int)
-    _dets_gdf['det_id'] = _dets_gdf.index.astype(int)
-    # We need to keep both geometries after sjoin to check the best intersection over union
-    _labels_gdf['label_geom'] = _labels_gdf.geometry
+    _dets_gdf, _labels_gdf, small_poly_gdf = prepare_sets(_dets_gdf, _labels_gdf, area_threshold)
 
-    # Filter detections and labels with area less than a thd value 
-    if area_threshold:
-        _dets_gdf['area'] = _dets_gdf.area
-        filter_dets_gdf = _dets_gdf[_dets_gdf['area']<area_threshold]
-        _dets_gdf = _dets_gdf[_dets_gdf['area']>=area_threshold].copy()
-        _labels_gdf['area'] = _labels_gdf.area
-        filter_labels_gdf = _labels_gdf[_labels_gdf['area']<area_threshold]
-        _labels_gdf = _labels_gdf[_labels_gdf['area']>=area_threshold].copy()
-        small_poly_gdf = pd.concat([filter_dets_gdf, filter_labels_gdf])
+    # Pairs of intersecting detections and labels with their IoU
+    candidates_df = get_candidate_pairs(_dets_gdf, _labels_gdf, min(iou_thresholds) if bbox_prefilter else None)
 
-    # TRUE POSITIVES
-    left_join = gpd.sjoin(_dets_gdf, _labels_gdf, how='left', predicate='intersects', lsuffix='left', rsuffix='right')
+    label_columns = _labels_gdf.columns.drop('geometry')
+    common_columns = [col for col in label_columns if col in _dets_gdf.columns]
 
-    # Test that something is detected
-    candidates_tp_gdf = candidates_tp_temp_gdf = left_join[left_join.label_id.notnull()].copy()
+    fractional_sets_dict = {}
+    for iou_threshold in iou_thresholds:
 
-    # Keep only matching years
-    if 'year_label' in candidates_tp_gdf.keys():
-        candidates_tp_temp_gdf = candidates_tp_temp_gdf[candidates_tp_temp_gdf.year_label.astype(int) == candidates_tp_temp_gdf.year_det.astype(int)]
-
-    # IoU computation between labels and detections
-    geom1 = candidates_tp_temp_gdf['geometry'].to_numpy().tolist()
-    geom2 = candidates_tp_temp_gdf['label_geom'].to_numpy().tolist()    
-    candidates_tp_temp_gdf.loc[:, ['IOU']] = [intersection_over_union(i, ii) for (i, ii) in zip(geom1, geom2)]
-
-    # Filter detections based on IoU value
-    best_matches_gdf = candidates_tp_temp_gdf.groupby(['det_id'], group_keys=False).apply(lambda g:g[g.IOU==g.IOU.max()])
-
-    # Detection, resp labels, with IOU lower than threshold value are considered as FP, resp FN, and saved as such
-    actual_matches_gdf = best_matches_gdf[best_matches_gdf['IOU'] >= iou_threshold].copy()
-    actual_matches_gdf = actual_matches_gdf.sort_values(by=['IOU'], ascending=False).drop_duplicates(subset=['label_id', 'year_det'])
-    actual_matches_gdf['IOU'] = actual_matches_gdf.IOU.round(3)
-
-    matched_label_ids = actual_matches_gdf['label_id'].unique().tolist()
-    matched_det_ids = actual_matches_gdf['det_id'].unique().tolist()
-
-    fp_gdf_temp = candidates_tp_gdf[~candidates_tp_gdf.det_id.isin(matched_det_ids)].drop_duplicates(subset=['det_id'], ignore_index=True)
-    fn_gdf_temp = candidates_tp_gdf[~candidates_tp_gdf.label_id.isin(matched_label_ids)].drop_duplicates(subset=['label_id'], ignore_index=True)
-    fn_gdf_temp.loc[:, 'geometry'] = fn_gdf_temp.label_geom
-
-    # Test that labels and detections share the same class (id starting at 1 for labels and at 0 for detections)
-    condition = actual_matches_gdf.label_class == actual_matches_gdf.det_class + 1
-    tp_gdf = actual_matches_gdf[condition].reset_index(drop=True)
-
-    mismatched_classes_gdf = actual_matches_gdf[~condition].reset_index(drop=True)
-    mismatched_classes_gdf.drop(columns=['x', 'y', 'z', 'dataset_right', 'label_geom'], errors='ignore', inplace=True)
-    mismatched_classes_gdf.rename(columns={'dataset_left': 'dataset'}, inplace=True)
-  
-    # FALSE POSITIVES
-    fp_gdf = left_join[left_join.label_id.isna()].copy()
-    assert(len(fp_gdf[fp_gdf.duplicated()]) == 0)
-    fp_gdf = pd.concat([fp_gdf_temp, fp_gdf], ignore_index=True)
-    fp_gdf.drop(
-        columns=_labels_gdf.drop(columns='geometry').columns.to_list() + ['index_right', 'dataset_right', 'label_geom', 'IOU'], 
-        errors='ignore', 
-        inplace=True
-    )
-    fp_gdf.rename(columns={'dataset_left': 'dataset'}, inplace=True)
+        # Filter detections based on IoU value
+        # Detection, resp labels, with IOU lower than threshold value are considered as FP, resp FN
+        actual_matches_df = get_matches(candidates_df, iou_threshold)
 
-    # FALSE NEGATIVES
-    right_join = gpd.sjoin(_dets_gdf, _labels_gdf, how='right', predicate='intersects', lsuffix='left', rsuffix='right')
+        # Gather the attributes of the matched detections and labels, the geometry being the one of the detection
+        matched_dets_df = _dets_gdf.loc[actual_matches_df.det_id].rename(columns={col: col + '_left' for col in common_columns})
+        matched_labels_df = pd.DataFrame(_labels_gdf.loc[actual_matches_df.label_id, label_columns]).rename(columns={col: col + '_right' for col in common_columns})
+        actual_matches_gdf = gpd.GeoDataFrame(
+            pd.concat([matched_dets_df.reset_index(drop=True), matched_labels_df.reset_index(drop=True)], axis=1),
+            crs=_dets_gdf.crs
+        )
+        actual_matches_gdf['IOU'] = actual_matches_df.IOU.round(3).to_numpy()
 
-    fn_gdf = right_join[right_join.score.isna()].copy()
-    if 'year_label' in fn_gdf.keys():
-        fn_gdf.drop_duplicates(subset=['label_id', 'year_label'], inplace=True)
-    else:
-        fn_gdf.drop_duplicates(subset=['label_id'], inplace=True)
-    fn_gdf = pd.concat([fn_gdf_temp, fn_gdf], ignore_index=True)
-    fn_gdf.drop(
-        columns=_dets_gdf.drop(columns='geometry').columns.to_list() + ['dataset_left', 'index_right', 'x', 'y', 'z', 'label_geom', 'IOU', 'index_left'], 
-        errors='ignore', 
-        inplace=True
-    )
-    fn_gdf.rename(columns={'dataset_right': 'dataset'}, inplace=True)
+        # Test that labels and detections share the same class (id starting at 1 for labels and at 0 for detections)
+        condition = actual_matches_gdf.label_class == actual_matches_gdf.det_class + 1
+        tp_gdf = actual_matches_gdf[condition].reset_index(drop=True)
+
+        mismatched_classes_gdf = actual_matches_gdf[~condition].reset_index(drop=True)
+        mismatched_classes_gdf.drop(columns=['x', 'y', 'z', 'dataset_right'], errors='ignore', inplace=True)
+        mismatched_classes_gdf.rename(columns={'dataset_left': 'dataset'}, inplace=True)
+    
+        # FALSE POSITIVES
+        fp_gdf = _dets_gdf[~_dets_gdf.det_id.isin(actual_matches_df.det_id)].reset_index(drop=True)
+
+        # FALSE NEGATIVES
+        fn_gdf = _labels_gdf[~_labels_gdf.label_id.isin(actual_matches_df.label_id)].reset_index(drop=True)
+        fn_gdf.drop(columns=['x', 'y', 'z'], errors='ignore', inplace=True)
+
+        fractional_sets_dict[iou_threshold] = (tp_gdf, fp_gdf, fn_gdf, mismatched_classes_gdf, small_poly_gdf)
+
+    return fractional_sets_dict
+
+
+def get_matches(candidates_df, iou_threshold=0.25):
+    """Select the matching pairs of detections and labels.
+    Each detection is paired with the label of highest IoU, then each label keeps the detection of highest IoU among the ones paired with it.
+    Ties are broken by the smallest id: the label with the smallest label_id for a detection, the detection with the smallest det_id for a label.
+
+    Args:
+        candidates_df (dataframe): pairs of detection and label ids with their IoU, as returned by get_candidate_pairs.
+        iou_threshold (float): threshold to apply on the IoU to determine if detections and labels can be matched. Defaults to 0.25.
 
-    return tp_gdf, fp_gdf, fn_gdf, mismatched_classes_gdf, small_poly_gdf
+    Returns:
+        dataframe: matching pairs of detection and label ids with their IoU.
+    """
+
+    actual_matches_df = get_best_labels(candidates_df, iou_threshold)
+    actual_matches_df = actual_matches_df.sort_values(by=['label_id', 'IOU', 'det_id'], ascending=[True, False, True], kind='stable')
+    actual_matches_df = actual_matches_df.drop_duplicates(subset=['label_id'])
+
+    return actual_matches_df
 
 
 def get_metrics(tp_gdf, fp_gdf, fn_gdf, mismatch_gdf, id_classes=0, method='macro-average'):
@@ -148,63 +366,225 @@ def get_metrics(tp_gdf, fp_gdf, fn_gdf, mismatch_gdf, id_classes=0, method='macr
             - float: f1 score.
     """
 
-    by_class_dict = {key: None for key in id_classes}
-    tp_k = by_class_dict.copy()
-    fp_k = by_class_dict.copy()
-    fn_k = by_class_dict.copy()
-    p_k = by_class_dict.copy()
-    r_k = by_class_dict.copy()
-    f1_k = by_class_dict.copy()
-    count_k = by_class_dict.copy()
-    pw_k = by_class_dict.copy()
-    rw_k = by_class_dict.copy()
- 
-    for id_cl in id_classes:
+    counts = get_confusion_matrix(tp_gdf, fp_gdf, fn_gdf, mismatch_gdf, id_classes).to_numpy()
 
-        pure_fp_count = 0 if fp_gdf.empty else len(fp_gdf[fp_gdf.det_class==id_cl])
-        pure_fn_count = 0 if fn_gdf.empty else len(fn_gdf[fn_gdf.label_class==id_cl+1])  # label class starting at 1 and id class at 0
+    # Mismatched detections are FP for the detection class and FN for the label class
+    tp_array = np.diag(counts)[:-1]
+    fp_array = counts[:, :-1].sum(axis=0) - tp_array
+    fn_array = counts[:-1, :].sum(axis=1) - tp_array
+    p_array, r_array, f1_array, accuracy, precision, recall, f1 = get_metrics_from_counts(tp_array, fp_array, fn_array, method)
 
-        mismatched_fp_count = 0 if mismatch_gdf.empty else len(mismatch_gdf[mismatch_gdf.det_class==id_cl])
-        mismatched_fn_count = 0 if mismatch_gdf.empty else len(mismatch_gdf[mismatch_gdf.label_class==id_cl+1])
-
-        fp_count = pure_fp_count + mismatched_fp_count
-        fn_count = pure_fn_count + mismatched_fn_count
-        tp_count = 0 if tp_gdf.empty else len(tp_gdf[tp_gdf.det_class==id_cl])
-
-        tp_k[id_cl] = tp_count
-        fp_k[id_cl] = fp_count
-        fn_k[id_cl] = fn_count
-    
-        p_k[id_cl] = 0 if tp_count == 0 else tp_count / (tp_count + fp_count)
-        r_k[id_cl] = 0 if tp_count == 0 else tp_count / (tp_count + fn_count)
-        f1_k[id_cl] = 0 if tp_count == 0 else 2 * p_k[id_cl] * r_k[id_cl] / (p_k[id_cl] + r_k[id_cl])
-        count_k[id_cl] = tp_count + fn_count 
-
-    accuracy = sum(tp_k.values()) / (sum(tp_k.values()) + sum(fp_k.values()) + sum(fn_k.values()))
-
-    if method == 'macro-average':   
-        precision = sum(p_k.values()) / len(id_classes)
-        recall = sum(r_k.values()) / len(id_classes)
-    elif method == 'macro-weighted-average': 
-        for id_cl in id_classes:
-            pw_k[id_cl] = 0 if sum(count_k.values()) == 0 else (count_k[id_cl] / sum(count_k.values())) * p_k[id_cl]
-            rw_k[id_cl] = 0 if sum(count_k.values()) == 0 else (count_k[id_cl] / sum(count_k.values())) * r_k[id_cl] 
-        precision = sum(pw_k.values()) / len(id_classes)
-        recall = sum(rw_k.values()) / len(id_classes)
-    elif method == 'micro-average':  
-        if sum(tp_k.values()) == 0:
-            precision = 0
-            recall = 0
-        else:
-            precision = sum(tp_k.values()) / (sum(tp_k.values()) + sum(fp_k.values()))
-            recall = sum(tp_k.values()) / (sum(tp_k.values()) + sum(fn_k.values()))
+    tp_k = {id_cl: int(tp_array[i]) for i, id_cl in enumerate(id_classes)}
+    fp_k = {id_cl: int(fp_array[i]) for i, id_cl in enumerate(id_classes)}
+    fn_k = {id_cl: int(fn_array[i]) for i, id_cl in enumerate(id_classes)}
+    p_k = {id_cl: float(p_array[i]) for i, id_cl in enumerate(id_classes)}
+    r_k = {id_cl: float(r_array[i]) for i, id_cl in enumerate(id_classes)}
+    f1_k = {id_cl: float(f1_array[i]) for i, id_cl in enumerate(id_classes)}
 
     if precision==0 and recall==0:
         return tp_k, fp_k, fn_k, p_k, r_k, 0, 0, 0, 0, 0
     
-    f1 = 2 * precision * recall / (precision + recall)
-    
-    return tp_k, fp_k, fn_k, p_k, r_k, f1_k, accuracy, precision, recall, f1
+    return tp_k, fp_k, fn_k, p_k, r_k, f1_k, float(accuracy), float(precision), float(recall), float(f1)
+
+
+def get_metrics_by_group(tagged_df, id_classes=0, group_name='tile_id', method='macro-average'):
+    """Determine the metrics of each group, e.g. each tile or each region, in one pass over the tagged detections.
+
+    Args:
+        tagged_df (dataframe): tagged detections and labels with the columns 'tag', 'det_class', 'label_class' and the group column
+        id_classes (list): list of the possible class ids. Defaults to 0.
+        group_name (str): name of the column with the group of each row. Defaults to 'tile_id'.
+        method (str): method used to compute multi-class metrics. Defaults to 'macro-average'.
+
+    Returns:
+        dataframe: TP, FP and FN counts, accuracy, precision, recall and f1 score of each group
+    """
+
+    groups, tp_by_group, fp_by_group, fn_by_group = get_counts_by_group(tagged_df, id_classes, group_name)
+    _, _, _, accuracy, precision, recall, f1 = get_metrics_from_counts(tp_by_group, fp_by_group, fn_by_group, method)
+
+    metrics_by_group_df = pd.DataFrame({
+        group_name: groups,
+        'TP': tp_by_group.sum(axis=1),
+        'FP': fp_by_group.sum(axis=1),
+        'FN': fn_by_group.sum(axis=1),
+        'accuracy': accuracy,
+        'precision': precision,
+        'recall': recall,
+        'f1': f1,
+    })
+
+    return metrics_by_group_df
+
+
+def get_metrics_by_iou(dets_gdf, labels_gdf, iou_thresholds, id_classes=0, method='macro-average', area_threshold=None, bbox_prefilter=False):
+    """Determine the metrics for several IoU thresholds, without recomputing the intersections between detections and labels.
+
+    Args:
+        dets_gdf (geodataframe): geodataframe of the detections.
+        labels_gdf (geodataframe): geodataframe of the labels.
+        iou_thresholds (list): thresholds to apply on the IoU to determine if detections and labels can be matched.
+        id_classes (list): list of the possible class ids. Defaults to 0.
+        method (str): method used to compute multi-class metrics
+        area_threshold (float): threshold applied on clipped label and detection polygons to discard the smallest ones. Default None
+        bbox_prefilter (bool): skip the IoU computation for the pairs which cannot reach the smallest IoU threshold based on their bounding boxes. Defaults to False.
+
+    Returns:
+        tuple:
+            - dict: tuple of geodataframes returned by get_fractional_sets for each IoU threshold
+            - dict: tuple of metrics returned by get_metrics for each IoU threshold
+    """
+
+    fractional_sets_dict = get_fractional_sets_by_iou(dets_gdf, labels_gdf, iou_thresholds, area_threshold, bbox_prefilter)
+    metrics_dict = {
+        iou_threshold: get_metrics(tp_gdf, fp_gdf, fn_gdf, mismatched_classes_gdf, id_classes, method)
+        for iou_threshold, (tp_gdf, fp_gdf, fn_gdf, mismatched_classes_gdf, _) in fractional_sets_dict.items()
+    }
+
+    return fractional_sets_dict, metrics_dict
+
+
+def get_metrics_from_counts(tp_k, fp_k, fn_k, method='macro-average'):
+    """Determine the metrics from the TP, FP and FN counts by class.
+    The counts can have leading dimensions, e.g. one row per group or per resample, the classes being on the last axis.
+
+    Args:
+        tp_k (array): TP count for each class
+        fp_k (array): FP count for each class
+        fn_k (array): FN count for each class
+        method (str): method used to compute multi-class metrics
+
+    Returns:
+        tuple:
+            - array: precision for each class
+            - array: recall for each class
+            - array: f1-score for each class
+            - array: accuracy
+            - array: precision
+            - array: recall
+            - array: f1 score.
+    """
+
+    tp_k = np.asarray(tp_k, dtype=float)
+    fp_k = np.asarray(fp_k, dtype=float)
+    fn_k = np.asarray(fn_k, dtype=float)
+    nb_classes = tp_k.shape[-1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p_k = np.where(tp_k == 0, 0, tp_k / (tp_k + fp_k))
+        r_k = np.where(tp_k == 0, 0, tp_k / (tp_k + fn_k))
+        f1_k = np.where(tp_k == 0, 0, 2 * p_k * r_k / (p_k + r_k))
+
+        tp = tp_k.sum(axis=-1)
+        fp = fp_k.sum(axis=-1)
+        fn = fn_k.sum(axis=-1)
+        accuracy = tp / (tp + fp + fn)
+
+        if method == 'macro-average':   
+            precision = p_k.sum(axis=-1) / nb_classes
+            recall = r_k.sum(axis=-1) / nb_classes
+        elif method == 'macro-weighted-average': 
+            count_k = tp_k + fn_k 
+            count = count_k.sum(axis=-1, keepdims=True)
+            weight_k = np.where(count == 0, 0, count_k / count)
+            precision = (weight_k * p_k).sum(axis=-1) / nb_classes
+            recall = (weight_k * r_k).sum(axis=-1) / nb_classes
+        elif method == 'micro-average':  
+            precision = np.where(tp == 0, 0, tp / (tp + fp))
+            recall = np.where(tp == 0, 0, tp / (tp + fn))
+        else:
+            raise ValueError(f"Unknown method to compute the metrics: {method}")
+
+        no_match = (precision == 0) & (recall == 0)
+        f1 = np.where(no_match, 0, 2 * precision * recall / (precision + recall))
+        accuracy = np.where(no_match, 0, accuracy)
+
+    return p_k, r_k, f1_k, accuracy, precision, recall, f1
+
+
+def get_score_sweep(dets_gdf, labels_gdf, id_classes=0, iou_threshold=0.25, area_threshold=None, bbox_prefilter=False):
+    """Compute the TP, FP, FN, precision, recall and f1 score at every score threshold with a single matching of the detections and labels.
+    The rules of get_matches are replayed for each threshold with cumulative counts: a detection paired with a label is a TP
+    as long as its score is over the threshold and the ones of the detections ranked before it for this label are not.
+
+    Args:
+        dets_gdf (geodataframe): geodataframe of the detections with a 'score' column.
+        labels_gdf (geodataframe): geodataframe of the labels.
+        id_classes (list): list of the possible class ids. Defaults to 0.
+        iou_threshold (float): threshold to apply on the IoU to determine if detections and labels can be matched. Defaults to 0.25.
+        area_threshold (float): threshold applied on clipped label and detection polygons to discard the smallest ones. Default None
+        bbox_prefilter (bool): skip the IoU computation for the pairs which cannot reach the IoU threshold based on their bounding boxes. Defaults to False.
+
+    Returns:
+        tuple:
+        - dataframe: TP, FP, FN, precision, recall and f1 score for each class and for all of them ('all') at each score threshold;
+        - dataframe: average precision, best f1 score and corresponding score threshold for each class and for all of them.
+    """
+
+    _dets_gdf, _labels_gdf, _ = prepare_sets(dets_gdf.reset_index(drop=True), labels_gdf.reset_index(drop=True), area_threshold)
+
+    det_scores = _dets_gdf.score.to_numpy()
+    det_classes = _dets_gdf.det_class.to_numpy()
+    label_classes = _labels_gdf.label_class.to_numpy()
+    thresholds = np.unique(np.concatenate([[0], det_scores]))[::-1]
+
+    candidates_df = get_candidate_pairs(_dets_gdf, _labels_gdf, iou_threshold if bbox_prefilter else None)
+    pairs_df = get_best_labels(candidates_df, iou_threshold)
+    pairs_df = pairs_df.sort_values(by=['label_id', 'IOU', 'det_id'], ascending=[True, False, True], kind='stable')
+    pairs_df['score'] = _dets_gdf.loc[pairs_df.det_id, 'score'].to_numpy()
+    pairs_df['det_class'] = _dets_gdf.loc[pairs_df.det_id, 'det_class'].to_numpy()
+    pairs_df['label_class'] = _labels_gdf.loc[pairs_df.label_id, 'label_class'].to_numpy()
+
+    # Highest score among the detections ranked before each detection for its label
+    first_of_label = pairs_df.label_id.ne(pairs_df.label_id.shift()).to_numpy()
+    blocking_scores = pairs_df.groupby('label_id').score.cummax().shift().to_numpy()
+    blocking_scores[first_of_label] = -np.inf
+    # The pair is a match for the thresholds in [blocking score, score[
+    pairs_df['last_unmatched_score'] = np.minimum(pairs_df.score.to_numpy(), blocking_scores)
+    correct_pairs_df = pairs_df[pairs_df.label_class == pairs_df.det_class + 1]
+
+    def count_over_thresholds(values):
+        return len(values) - np.searchsorted(np.sort(values), thresholds, side='right')
+
+    curve_df_list = []
+    for id_cl in id_classes:
+        correct_pairs_k_df = correct_pairs_df[correct_pairs_df.det_class == id_cl]
+        tp = count_over_thresholds(correct_pairs_k_df.score.to_numpy()) - count_over_thresholds(correct_pairs_k_df.last_unmatched_score.to_numpy())
+        curve_df_list.append(pd.DataFrame({
+            'class': id_cl,
+            'threshold': thresholds,
+            'TP': tp,
+            'FP': count_over_thresholds(det_scores[det_classes == id_cl]) - tp,
+            'FN': (label_classes == id_cl + 1).sum() - tp,   # label class starting at 1 and id class at 0
+        }))
+    curve_df = pd.concat(curve_df_list, ignore_index=True)
+    all_classes_df = curve_df.groupby('threshold', as_index=False, sort=False)[['TP', 'FP', 'FN']].sum()
+    all_classes_df['class'] = 'all'
+    curve_df = pd.concat([curve_df, all_classes_df], ignore_index=True)
+
+    tp = curve_df.TP.to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        curve_df['precision'] = np.where(tp == 0, 0, tp / (tp + curve_df.FP.to_numpy()))
+        curve_df['recall'] = np.where(tp == 0, 0, tp / (tp + curve_df.FN.to_numpy()))
+        curve_df['f1'] = np.where(tp == 0, 0, 2 * curve_df.precision * curve_df.recall / (curve_df.precision + curve_df.recall))
+
+    # Average precision as the area under the interpolated precision-recall curve
+    summary_list = []
+    for id_cl, class_curve_df in curve_df.groupby('class', sort=False):
+        recall = class_curve_df.recall.to_numpy()
+        interpolated_precision = np.maximum.accumulate(class_curve_df.precision.to_numpy()[::-1])[::-1]
+        best_f1_row = class_curve_df.loc[class_curve_df.f1.idxmax()]
+        summary_list.append({
+            'class': id_cl,
+            'AP': np.sum(np.diff(recall, prepend=0) * interpolated_precision),
+            'best_threshold': best_f1_row.threshold,
+            'precision': best_f1_row.precision,
+            'recall': best_f1_row.recall,
+            'f1': best_f1_row.f1,
+        })
+    summary_df = pd.DataFrame.from_records(summary_list)
+
+    return curve_df, summary_df
 
 
 def intersection_over_union(polygon1_shape, polygon2_shape):
@@ -222,4 +602,76 @@ def intersection_over_union(polygon1_shape, polygon2_shape):
     polygon_intersection = polygon1_shape.intersection(polygon2_shape).area
     polygon_union = polygon1_shape.area + polygon2_shape.area - polygon_intersection
 
-    return polygon_intersection / polygon_union
\ No newline at end of file
+    return polygon_intersection / polygon_union
+
+
+def prepare_sets(dets_gdf, labels_gdf, area_threshold=None):
+    """Add id columns to the detections and labels and discard the smallest polygons.
+
+    Args:
+        dets_gdf (geodataframe): geodataframe of the detections with a reset index.
+        labels_gdf (geodataframe): geodataframe of the labels with a reset index.
+        area_threshold (float): threshold applied on clipped label and detection polygons to discard the smallest ones. Default None
+
+    Returns:
+        tuple:
+        - geodataframe: detections with a 'det_id' column;
+        - geodataframe: labels with a 'label_id' column;
+        - geodataframe: label and detection polygons with an area smaller than the threshold.
+    """
+
+    small_poly_gdf = gpd.GeoDataFrame()
+
+    # we add a id column to the labels dataset, which should not exist in detections too;
+    # this allows us to distinguish matching from non-matching detections
+    labels_gdf['label_id'] = labels_gdf.index.astype(int)
+    dets_gdf['det_id'] = dets_gdf.index.astype(int)
+
+    # Filter detections and labels with area less than a thd value 
+    if area_threshold:
+        dets_gdf['area'] = dets_gdf.area
+        filter_dets_gdf = dets_gdf[dets_gdf['area']<area_threshold]
+        dets_gdf = dets_gdf[dets_gdf['area']>=area_threshold].copy()
+        labels_gdf['area'] = labels_gdf.area
+        filter_labels_gdf = labels_gdf[labels_gdf['area']<area_threshold]
+        labels_gdf = labels_gdf[labels_gdf['area']>=area_threshold].copy()
+        small_poly_gdf = pd.concat([filter_dets_gdf, filter_labels_gdf])
+
+    return dets_gdf, labels_gdf, small_poly_gdf
+
+
+def vectorized_intersection_over_union(polygons1, polygons2, min_iou=None):
+    """Determine the intersection area over union area (IOU) of two arrays of polygons, pair by pair
+
+    Args:
+        polygons1 (array): first polygons
+        polygons2 (array): second polygons
+        min_iou (float): if provided, the IoU of the pairs that cannot reach this value given their bounding boxes is not computed and set to 0. Defaults to None.
+
+    Returns:
+        array: Unrounded ratio between the intersection and union area of each pair
+    """
+
+    polygons1 = np.asarray(polygons1, dtype=object)
+    polygons2 = np.asarray(polygons2, dtype=object)
+    area1 = shapely.area(polygons1)
+    area2 = shapely.area(polygons2)
+    iou = np.zeros(len(polygons1))
+
+    if min_iou:
+        # The intersection area cannot exceed the one of the bounding boxes nor the one of the smallest polygon
+        bounds1 = shapely.bounds(polygons1)
+        bounds2 = shapely.bounds(polygons2)
+        dx = np.minimum(bounds1[:, 2], bounds2[:, 2]) - np.maximum(bounds1[:, 0], bounds2[:, 0])
+        dy = np.minimum(bounds1[:, 3], bounds2[:, 3]) - np.maximum(bounds1[:, 1], bounds2[:, 1])
+        max_intersection = np.minimum(np.clip(dx, 0, None) * np.clip(dy, 0, None), np.minimum(area1, area2))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            candidates = max_intersection / (area1 + area2 - max_intersection) >= min_iou
+    else:
+        candidates = np.ones(len(polygons1), dtype=bool)
+
+    intersection = shapely.area(shapely.intersection(polygons1[candidates], polygons2[candidates]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou[candidates] = intersection / (area1[candidates] + area2[candidates] - intersection)
+
+    return iou
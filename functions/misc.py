@@ -1,9 +1,44 @@
 import sys
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from joblib import Parallel, delayed
 from loguru import logger
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from shapely.validation import make_valid
 
 
+def attribute_merged_detections(join_df, merged_ids, id_name='id', class_name='det_class', score_name='score', area_name='area'):
+    '''
+    Attribute a class and a score to merged detections from the raw detections they intersect.
+    The score is averaged over all the intersecting detections and the class is the one with the largest cumulated area.
+    In case of equal areas, the smallest class id is selected. Merged detections without any intersecting detection get the class 0.
+
+    - join_df: dataframe of the merged detections joined with the raw ones, with one row per (merged, raw) pair
+    - merged_ids: ids of the merged detections
+    - id_name (string): name of the column with the id of the merged detections
+    - class_name (string): name of the column with the class of the raw detections
+    - score_name (string): name of the column with the score of the raw detections
+    - area_name (string): name of the column with the area of the raw detections
+
+    return: a dataframe indexed by the merged ids with the attributed class and score
+    '''
+
+    score_df = join_df.groupby(id_name)[score_name].mean()
+
+    area_by_class_df = join_df.groupby([id_name, class_name], as_index=False)[area_name].sum()
+    area_by_class_df.sort_values(by=[id_name, area_name, class_name], ascending=[True, False, True], inplace=True)
+    class_df = area_by_class_df.drop_duplicates(subset=[id_name]).set_index(id_name)[class_name]
+
+    attributes_df = pd.DataFrame(index=pd.Index(merged_ids, name=id_name))
+    attributes_df[class_name] = class_df.reindex(attributes_df.index).fillna(0).astype(class_df.dtype if len(class_df) > 0 else int)
+    attributes_df[score_name] = score_df.reindex(attributes_df.index)
+
+    return attributes_df
+
+
 def check_validity(poly_gdf, correct=False):
     '''
     Test if all the geometry of a dataset are valid. When it is not the case, correct the geometries with a buffer of 0 m
@@ -38,6 +73,30 @@ def check_validity(poly_gdf, correct=False):
     return poly_gdf
 
 
+def drop_duplicate_geometries(gdf, subset=None, precision=None):
+    '''
+    Remove the duplicated geometries of a GeoDataFrame, keeping the first occurrence. The geometries are compared through a hash
+    of their normalized WKB, so the same shape with another vertex order or starting point is considered a duplicate.
+
+    - gdf: GeoDataFrame to deduplicate
+    - subset (list): other columns that must be equal as well for two rows to be duplicates, e.g. the year
+    - precision (float): size of the grid on which the coordinates are snapped before the comparison, none by default
+
+    return: the GeoDataFrame without the duplicated rows
+    '''
+
+    geoms = gdf.geometry.to_numpy()
+    if precision:
+        geoms = shapely.set_precision(geoms, precision)
+    wkb = shapely.to_wkb(shapely.normalize(geoms))
+
+    keys_df = pd.DataFrame({'geom_hash': pd.util.hash_array(wkb)}, index=gdf.index)
+    if subset:
+        keys_df = pd.concat([keys_df, gdf[subset]], axis=1)
+
+    return gdf[~keys_df.duplicated(keep='first').to_numpy()]
+
+
 def format_logger(logger):
 
     logger.remove()
@@ -53,19 +112,234 @@ def format_logger(logger):
     return logger
 
 
-def merge_polygons(gdf, id_name='id'):
+def get_connected_groups(geoms):
+    '''
+    Group the geometries intersecting each other, directly or through other geometries.
+
+    - geoms: array of geometries
+
+    return: array with the group number of each geometry
+    '''
+
+    tree = shapely.STRtree(geoms)
+    input_idx, tree_idx = tree.query(geoms, predicate='intersects')
+    adjacency_matrix = coo_matrix((np.ones(len(input_idx), dtype=bool), (input_idx, tree_idx)), shape=(len(geoms), len(geoms)))
+    _, groups = connected_components(adjacency_matrix, directed=False)
+
+    return groups
+
+
+def get_spatial_partitions(gdf, nb_partitions, margin=0):
+    '''
+    Split a GeoDataFrame into spatially independent partitions: the bounding boxes of the geometries, enlarged by the margin,
+    never intersect between two partitions. The geometries are sorted along the x-axis and cut where no bounding box spans the gap,
+    then the resulting clusters are gathered into partitions of similar size.
+
+    - gdf: GeoDataFrame to split
+    - nb_partitions (int): maximum number of partitions
+    - margin (float): distance added around each bounding box
+
+    return: list of arrays with the positional indices of the geometries of each partition
+    '''
+
+    if nb_partitions <= 1 or len(gdf) <= 1:
+        return [np.arange(len(gdf))]
+
+    bounds = gdf.bounds.to_numpy()
+    order = np.argsort(bounds[:, 0] - margin, kind='stable')
+    minx = bounds[order, 0] - margin
+    maxx = np.maximum.accumulate(bounds[order, 2] + margin)
+
+    # Start of each cluster of geometries overlapping along the x-axis
+    cluster_starts = np.concatenate([[0], np.flatnonzero(minx[1:] > maxx[:-1]) + 1])
+    partition_of_cluster = cluster_starts * nb_partitions // len(gdf)
+    partition_starts = cluster_starts[np.concatenate([[True], np.diff(partition_of_cluster) > 0])]
+
+    return np.split(order, partition_starts[1:])
+
+
+def get_zone_ids(gdf, zones_gdf, attribute='id'):
+    '''
+    Get the zone, e.g. the tile, in which each geometry lies, based on its representative point.
+    The point is always inside the geometry, so each geometry is attributed to one zone only, the first one if zones overlap.
+
+    - gdf: GeoDataFrame with the geometries to tag
+    - zones_gdf: GeoDataFrame with the zones, in the same CRS
+    - attribute (str): name of the zone attribute to return
+
+    return: Series with the attribute of the zone of each geometry, NaN for the geometries outside of all zones
+    '''
+
+    points = gdf.geometry.representative_point()
+    point_idx, zone_idx = zones_gdf.sindex.query(points, predicate='intersects')
+
+    # Keep the first zone for each point
+    order = np.lexsort((zone_idx, point_idx))
+    point_idx, first_idx = np.unique(point_idx[order], return_index=True)
+    zone_idx = zone_idx[order][first_idx]
+
+    zone_ids = pd.Series(np.nan, index=gdf.index, dtype=object)
+    zone_ids.iloc[point_idx] = zones_gdf[attribute].iloc[zone_idx].to_numpy()
+
+    return zone_ids
+
+
+def merge_polygons(gdf, id_name='id', engine='unary_union', n_jobs=1):
     '''
     Merge overlapping polygons in a GeoDataFrame.
+    With the 'unary_union' engine, all the polygons are merged in one geometry before being exploded.
+    With the 'graph' engine, the groups of intersecting polygons are found with an STRtree and the connected components
+    of the intersection graph, then each group is merged on its own.
+    With the 'partitioned' engine, the polygons are merged by cell of a regular grid, see partitioned_union.
 
     - gdf: GeoDataFrame with polygon geometries
     - id_name (string): name of the index column
+    - engine (string): 'unary_union', 'graph' or 'partitioned'
+    - n_jobs (int): number of processes used to merge the groups or the cells with the 'graph' and 'partitioned' engines
 
     return: a GeoDataFrame with polygons
     '''
 
-    merge_gdf = gdf.copy()
-    merge_gdf = gpd.GeoDataFrame(geometry=[merge_gdf.geometry.unary_union], crs=gdf.crs) 
+    if engine == 'partitioned':
+        return partitioned_union(gdf, id_name=id_name, n_jobs=n_jobs)
+    elif engine == 'graph':
+        geoms = gdf.geometry.to_numpy()
+        merged_geoms = union_groups(geoms, get_connected_groups(geoms), n_jobs=n_jobs) if len(geoms) > 0 else []
+        merge_gdf = gpd.GeoDataFrame(geometry=merged_geoms, crs=gdf.crs)
+    elif engine == 'unary_union':
+        merge_gdf = gdf.copy()
+        merge_gdf = gpd.GeoDataFrame(geometry=[merge_gdf.geometry.unary_union], crs=gdf.crs) 
+    else:
+        logger.error(f"Unknown engine to merge polygons: {engine}. Supported values are 'unary_union', 'graph' and 'partitioned'.")
+        sys.exit(1)
     merge_gdf = merge_gdf.explode(ignore_index=True)
     merge_gdf[id_name] = merge_gdf.index 
 
-    return merge_gdf
\ No newline at end of file
+    return merge_gdf
+
+
+def merge_seam_polygons(gdf, tiles_gdf, id_name='id'):
+    '''
+    Merge the polygons crossing the tile edges. Only the polygons intersecting a tile boundary are indexed
+    and merged with the ones they intersect. Polygons within a tile are left untouched.
+
+    - gdf: GeoDataFrame with polygon geometries
+    - tiles_gdf: GeoDataFrame with the tile geometries
+    - id_name (string): name of the index column of the merged polygons
+
+    return: a tuple with
+        - a GeoDataFrame with the merged polygons crossing the tile edges
+        - a GeoDataFrame with the polygons within a tile
+    '''
+
+    geoms = gdf.geometry.to_numpy()
+    tile_edges = shapely.boundary(tiles_gdf.geometry.to_numpy())
+
+    tree = shapely.STRtree(geoms)
+    _, seam_idx = tree.query(tile_edges, predicate='intersects')
+    seam_condition = np.zeros(len(geoms), dtype=bool)
+    seam_condition[seam_idx] = True
+
+    seam_geoms = geoms[seam_condition]
+    merged_geoms = union_groups(seam_geoms, get_connected_groups(seam_geoms)) if len(seam_geoms) > 0 else []
+    merge_gdf = gpd.GeoDataFrame(geometry=merged_geoms, crs=gdf.crs)
+    merge_gdf = merge_gdf.explode(ignore_index=True)
+    merge_gdf[id_name] = merge_gdf.index
+
+    within_gdf = gdf[~seam_condition].reset_index(drop=True)
+
+    return merge_gdf, within_gdf
+
+
+def partitioned_union(gdf, cell_size=None, cells_gdf=None, id_name='id', n_jobs=1):
+    '''
+    Merge overlapping polygons in a GeoDataFrame by spatial partition. Each polygon is assigned to the grid cell containing
+    a point on its surface and the polygons of each cell are merged in a worker process. Only the merged polygons crossing or
+    touching the border of their cell, and the ones they intersect, are merged again together.
+
+    - gdf: GeoDataFrame with polygon geometries
+    - cell_size (float): side of the cells of the regular grid, in the units of the CRS. Defaults to a grid of about 16 cells per job.
+    - cells_gdf: GeoDataFrame with the cells to use instead of a regular grid, e.g. the XYZ tiles, in the same CRS as gdf
+    - id_name (string): name of the index column
+    - n_jobs (int): number of processes used to merge the cells
+
+    return: a GeoDataFrame with polygons
+    '''
+
+    geoms = gdf.geometry.to_numpy()
+    if len(geoms) == 0:
+        return merge_polygons(gdf, id_name=id_name, engine='graph')
+    points = shapely.point_on_surface(geoms)
+
+    if cells_gdf is not None:
+        cells = cells_gdf.geometry.to_numpy()
+        point_idx, cell_idx = shapely.STRtree(cells).query(points, predicate='intersects')
+        # Points on a shared edge are assigned to the first cell, points outside the cells to an extra one
+        point_idx, first_match = np.unique(point_idx, return_index=True)
+        geom_cells = np.full(len(geoms), len(cells))
+        geom_cells[point_idx] = cell_idx[first_match]
+        cells = np.append(cells, None)
+    else:
+        minx, miny, maxx, maxy = gdf.total_bounds
+        if not cell_size:
+            nb_cells_by_side = max(1, int(np.sqrt(16 * max(n_jobs, 1))))
+            cell_size = max(maxx - minx, maxy - miny) / nb_cells_by_side or 1
+        col = np.floor((shapely.get_x(points) - minx) / cell_size).astype(int)
+        row = np.floor((shapely.get_y(points) - miny) / cell_size).astype(int)
+        cell_keys, geom_cells = np.unique(np.stack([col, row], axis=1), axis=0, return_inverse=True)
+        geom_cells = geom_cells.ravel()
+        cells = shapely.box(
+            minx + cell_keys[:, 0] * cell_size, miny + cell_keys[:, 1] * cell_size, 
+            minx + (cell_keys[:, 0] + 1) * cell_size, miny + (cell_keys[:, 1] + 1) * cell_size
+        )
+
+    # Merge the polygons of each cell
+    occupied_cells = np.unique(geom_cells)
+    cell_unions = Parallel(n_jobs=n_jobs)(delayed(shapely.union_all)(geoms[geom_cells==cell]) for cell in occupied_cells)
+    parts, part_idx = shapely.get_parts(np.array(cell_unions, dtype=object), return_index=True)
+    part_cells = cells[occupied_cells[part_idx]]
+
+    # Merge again the polygons crossing or touching a cell border with the ones they intersect
+    crossing_condition = np.array([cell is None for cell in part_cells])
+    crossing_condition[~crossing_condition] = ~shapely.contains_properly(part_cells[~crossing_condition].astype(object), parts[~crossing_condition])
+    _, neighbour_idx = shapely.STRtree(parts).query(parts[crossing_condition], predicate='intersects')
+    seam_condition = crossing_condition.copy()
+    seam_condition[neighbour_idx] = True
+
+    seam_parts = parts[seam_condition]
+    seam_merged_geoms = shapely.get_parts(union_groups(seam_parts, get_connected_groups(seam_parts))) if len(seam_parts) > 0 else []
+
+    merge_gdf = gpd.GeoDataFrame(geometry=np.concatenate([parts[~seam_condition], seam_merged_geoms]), crs=gdf.crs)
+    merge_gdf[id_name] = merge_gdf.index
+
+    return merge_gdf
+
+
+def union_groups(geoms, groups, n_jobs=1):
+    '''
+    Merge the geometries of each group.
+
+    - geoms: array of geometries
+    - groups: array with the group number of each geometry
+    - n_jobs (int): number of processes used to merge the groups with more than one geometry
+
+    return: list of the merged geometries, one per group
+    '''
+
+    order = np.argsort(groups, kind='stable')
+    split_idx = np.flatnonzero(np.diff(groups[order])) + 1
+    geoms_by_group = np.split(geoms[order], split_idx)
+
+    if n_jobs == 1:
+        merged_geoms = [
+            group_geoms[0] if len(group_geoms) == 1 else shapely.union_all(group_geoms) 
+            for group_geoms in geoms_by_group
+        ]
+    else:
+        merged_geoms = [group_geoms[0] for group_geoms in geoms_by_group]
+        multiple_geoms_idx = [idx for idx, group_geoms in enumerate(geoms_by_group) if len(group_geoms) > 1]
+        unions = Parallel(n_jobs=n_jobs)(delayed(shapely.union_all)(geoms_by_group[idx]) for idx in multiple_geoms_idx)
+        for idx, union in zip(multiple_geoms_idx, unions):
+            merged_geoms[idx] = union
+
+    return merged_geoms
\ No newline at end of file
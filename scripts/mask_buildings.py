@@ -5,6 +5,8 @@ import os
 import sys
 import time
 import argparse
+import hashlib
+import json
 import yaml
 from glob import glob
 from tqdm import tqdm
@@ -12,9 +14,11 @@ from tqdm import tqdm
 import geopandas as gpd
 import numpy as np
 import rasterio
+import shapely
+from joblib import Parallel, delayed
 from rasterio.mask import mask
 from rasterio.features import rasterize
-from shapely.geometry import Polygon, mapping
+from shapely.geometry import mapping
 
 sys.path.insert(0, '.')
 import functions.misc as misc
@@ -24,17 +28,162 @@ logger = misc.format_logger(logger)
 
 # Define functions ------------------------------
 
-def poly_from_utm(polygon, transform):
-    poly_pts = []
+def get_cache_entry(tile, buildings_geoms, output_format):
+    '''
+    Get the cache entry of a tile, made of the checksum of the tile file, a hash of the building polygons intersecting it
+    and the output format. The hash of the buildings does not depend on their order nor on their vertex order.
+
+    - tile: path to the tile
+    - buildings_geoms: array of building polygons intersecting the tile, clipped to its bounds
+    - output_format (str): format of the output, as the mask depends on it
+
+    return: dictionary with the tile checksum, the buildings hash and the output format
+    '''
+
+    with open(tile, 'rb') as fp:
+        tile_checksum = hashlib.sha256(fp.read()).hexdigest()
+
+    buildings_hash = hashlib.sha256()
+    for wkb in sorted(shapely.to_wkb(shapely.normalize(buildings_geoms))):
+        buildings_hash.update(wkb)
+
+    return {'tile_checksum': tile_checksum, 'buildings_hash': buildings_hash.hexdigest(), 'output_format': output_format}
+
+
+def get_local_buildings(tile, buildings_tree):
+    '''
+    Get the building footprints intersecting a tile, clipped to its bounds.
+
+    - tile: path to the tile
+    - buildings_tree: STRtree of the building footprints, in the CRS of the tile
+
+    return: array of the clipped building polygons, in the order of the building layer
+    '''
+
+    try:
+        with rasterio.open(tile) as src:
+            bounds = src.bounds
+    except rasterio.errors.RasterioIOError:
+        # The error is reported by the worker when it opens the tile
+        return np.array([], dtype=object)
+
+    buildings_idx = buildings_tree.query(shapely.box(*bounds), predicate='intersects')
+    clipped_geoms = shapely.clip_by_rect(buildings_tree.geometries.take(np.sort(buildings_idx)), *bounds)
+    clipped_parts = shapely.get_parts(clipped_geoms)
+
+    return clipped_parts[shapely.get_type_id(clipped_parts) == 3]
+
+
+def get_mask_path(tile, output_dir, transparency, mask_format='uint8'):
+    '''
+    Get the path of the file written for a tile.
+
+    - tile: path to the tile
+    - output_dir: folder where the masked image or the mask is written
+    - transparency (bool): whether a masked image or a binary mask is written
+    - mask_format (str): format of the binary mask, the GDAL mask sidecars being written next to the tiles
+
+    return: path of the masked image or of the mask
+    '''
+
+    if not transparency and mask_format == 'msk':
+        return tile + '.msk'
     
-    for i in np.array(polygon.exterior.coords):
-        
-        # Convert polygons to the image CRS
-        poly_pts.append(~transform * tuple(i))
-        
-    # Generate a polygon object
-    new_poly = Polygon(poly_pts)
-    return new_poly
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(tile))[0] + '.tif')
+
+
+def mask_tile(tile, buildings_geoms, output_dir, transparency, mask_format='uint8'):
+    '''
+    Read a tile, mask it with the building footprints and write the result in the output folder.
+    Errors are returned rather than raised, so that one corrupted tile does not stop the other ones.
+
+    - tile: path to the tile
+    - buildings_geoms: array of building polygons intersecting the tile, in the CRS of the tile
+    - output_dir: folder where the masked image or the mask is written
+    - transparency (bool): whether to write the image with the pixels outside of the buildings set to nodata, or a binary mask
+    - mask_format (str): format of the binary mask, 'uint8' for a uint8 GeoTIFF with a nodata value of 99, '1bit' for a 1-bit
+        GeoTIFF compressed with deflate, 'msk' for a GDAL mask sidecar next to the original tile
+
+    return: None if the tile was masked, the error message otherwise
+    '''
+
+    filepath = get_mask_path(tile, output_dir, transparency, mask_format)
+
+    try:
+        if transparency:
+            with rasterio.open(tile) as src:
+                if len(buildings_geoms) > 0:
+                    geoms_list = [mapping(geom) for geom in buildings_geoms]
+                    mask_image, mask_transform = mask(src, geoms_list)
+                else:
+                    mask_image = np.full((src.count, src.height, src.width), src.nodata or 0, dtype=src.dtypes[0])
+                    mask_transform = src.transform
+                mask_meta = src.meta
+                
+            mask_meta.update({'transform': mask_transform})
+            
+            with rasterio.open(filepath, 'w', **mask_meta) as dst:
+                dst.write(mask_image)
+
+        else:
+            with rasterio.open(tile, "r") as src:
+                tile_meta = src.meta
+
+            im_size = (tile_meta['height'], tile_meta['width'])
+
+            if len(buildings_geoms) > 0:
+                mask_image = rasterize(shapes=buildings_geoms, out_shape=im_size, transform=tile_meta['transform'])
+            else:
+                mask_image = np.zeros(im_size, dtype='uint8')
+
+            if mask_format == 'msk':
+                # GDAL writes the mask in <tile>.msk and leaves the tile untouched
+                with rasterio.Env(GDAL_TIFF_INTERNAL_MASK=False):
+                    with rasterio.open(tile, 'r+') as dst:
+                        dst.write_mask(mask_image * 255)
+            else:
+                mask_meta = tile_meta.copy()
+                if mask_format == '1bit':
+                    mask_meta.update({'count': 1, 'dtype': 'uint8', 'nodata': None, 'nbits': 1, 'compress': 'deflate'})
+                else:
+                    mask_meta.update({'count': 1, 'dtype': 'uint8', 'nodata': 99})
+                
+                with rasterio.open(filepath, 'w', **mask_meta) as dst:
+                    dst.write(mask_image, 1)
+
+    except Exception as e:
+        return str(e)
+
+
+def update_mask(tile, buildings_geoms, output_dir, transparency, mask_format='uint8', use_cache=False, cached_entry=None):
+    '''
+    Mask a tile, unless its mask was already produced from the same tile, buildings and output format, according to the cache.
+
+    - tile: path to the tile
+    - buildings_geoms: array of building polygons intersecting the tile, clipped to its bounds
+    - output_dir: folder where the masked image or the mask is written
+    - transparency (bool): whether to write the image with the pixels outside of the buildings set to nodata, or a binary mask
+    - mask_format (str): format of the binary mask, see mask_tile
+    - use_cache (bool): whether to compare the tile with its cache entry, otherwise the tile is always masked
+    - cached_entry (dict): cache entry of the tile from the previous run, None if not available
+
+    return: tuple with the cache entry of the tile, the error message or None, and a boolean telling if the mask was up to date
+    '''
+
+    if not use_cache:
+        return None, mask_tile(tile, buildings_geoms, output_dir, transparency, mask_format), False
+
+    try:
+        cache_entry = get_cache_entry(tile, buildings_geoms, 'masked_image' if transparency else mask_format)
+    except Exception as e:
+        return None, str(e), False
+
+    if cache_entry == cached_entry and os.path.exists(get_mask_path(tile, output_dir, transparency, mask_format)):
+        return cache_entry, None, True
+
+    error = mask_tile(tile, buildings_geoms, output_dir, transparency, mask_format)
+
+    return (None if error else cache_entry), error, False
 
 
 if __name__ == "__main__":
@@ -57,6 +206,13 @@ if __name__ == "__main__":
     BUILDINGS_SHP = cfg['buildings_shp']
     IMAGE_FOLDER = cfg['image_dir']
     TRANSPARENCY = cfg['transparency']
+    MASK_FORMAT = cfg['mask_format'] if 'mask_format' in cfg.keys() else 'uint8'
+    USE_CACHE = cfg['use_cache'] if 'use_cache' in cfg.keys() else False
+    N_JOBS = cfg['n_jobs'] if 'n_jobs' in cfg.keys() else 1
+
+    if MASK_FORMAT not in ['uint8', '1bit', 'msk']:
+        logger.error(f"Unknown mask format: {MASK_FORMAT}. Supported values are 'uint8', '1bit' and 'msk'.")
+        sys.exit(1)
 
     os.chdir(WORKING_DIR)
 
@@ -68,42 +224,56 @@ if __name__ == "__main__":
         buildings_gdf = buildings_gdf.to_crs(epsg=3857)
 
     logger.info('Process vector data...')
-    buildings_gdf = buildings_gdf.buffer(0)
-    merged_buildings_geoms = buildings_gdf.unary_union
+    buildings_geoms = buildings_gdf.buffer(0).explode(index_parts=False)
+    buildings_tree = shapely.STRtree(buildings_geoms[~buildings_geoms.is_empty].to_numpy())
 
-    for tile in tqdm(tiles, desc='Produce masks', total=len(tiles)):
+    if TRANSPARENCY:
+        output_dir = os.path.join(IMAGE_FOLDER, 'masked_images')
+    elif MASK_FORMAT == 'msk':
+        output_dir = IMAGE_FOLDER
+    else:
+        output_dir = os.path.join(IMAGE_FOLDER, 'mask')
+    os.makedirs(output_dir, exist_ok=True)
 
-        if TRANSPARENCY:
-            geoms_list = [mapping(merged_buildings_geoms)]
-
-            with rasterio.open(tile) as src:
-                mask_image, mask_transform = mask(src, geoms_list)
-                mask_meta = src.meta
-                
-            mask_meta.update({'transform': mask_transform})
-            filepath = os.path.join(os.makedirs((os.path.join(IMAGE_FOLDER, 'masked_images')),
-                                os.path.splitext(os.path.basename(tile))[0] + '.tif'), exist_ok=True)
-            
-            with rasterio.open(filepath, 'w', **mask_meta) as dst:
-                dst.write(mask_image)
+    # The cache manifest records, for each tile, the tile and buildings from which its mask was produced
+    cache_filepath = os.path.join(output_dir, 'mask_cache.json')
+    cache_dict = {}
+    if USE_CACHE and os.path.exists(cache_filepath):
+        with open(cache_filepath) as fp:
+            cache_dict = json.load(fp)
+        logger.info(f'{len(cache_dict)} tile(s) found in the cache manifest.')
+    elif os.path.exists(cache_filepath):
+        # The masks are rewritten without the cache, so its manifest would not describe them anymore
+        os.remove(cache_filepath)
+        logger.info('The cache manifest was removed, as the masks are produced without the cache.')
 
-        else:
-            with rasterio.open(tile, "r") as src:
-                tile_img = src.read()
-                tile_meta = src.meta
+    # The tiles are handed over lazily with their local buildings, the results come back in the order of the tiles
+    tasks = (
+        delayed(update_mask)(
+            tile, get_local_buildings(tile, buildings_tree), output_dir, TRANSPARENCY, MASK_FORMAT, USE_CACHE, cache_dict.get(tile)
+        )
+        for tile in tiles
+    )
+    results = Parallel(n_jobs=N_JOBS, return_as='generator')(tasks)
 
-            im_size = (tile_meta['height'], tile_meta['width'])
+    new_cache_dict = {}
+    failed_tiles_dict = {}
+    nb_cached_tiles = 0
+    for tile, (cache_entry, error, up_to_date) in tqdm(zip(tiles, results), desc='Produce masks', total=len(tiles)):
+        if error:
+            failed_tiles_dict[tile] = error
+        elif cache_entry:
+            new_cache_dict[tile] = cache_entry
+        nb_cached_tiles += up_to_date
 
-            polygons = [poly_from_utm(geom, src.meta['transform']) for geom in merged_buildings_geoms.geoms]
-            mask_image = rasterize(shapes=polygons, out_shape=im_size)
+    if USE_CACHE:
+        logger.info(f'{nb_cached_tiles} mask(s) out of {len(tiles)} were up to date and kept.')
+        with open(cache_filepath, 'w') as fp:
+            json.dump(new_cache_dict, fp, indent=1)
 
-            mask_meta = src.meta.copy()
-            mask_meta.update({'count': 1, 'dtype': 'uint8', 'nodata': 99})
-   
-            filepath = os.path.join(os.makedirs((os.path.join(IMAGE_FOLDER, 'mask')),
-                                os.path.splitext(os.path.basename(tile))[0] + '.tif'), exist_ok=True)
-            
-            with rasterio.open(filepath, 'w', **mask_meta) as dst:
-                dst.write(mask_image, 1)
+    if len(failed_tiles_dict) > 0:
+        logger.error(f'{len(failed_tiles_dict)} tile(s) out of {len(tiles)} could not be masked:')
+        for tile, error in failed_tiles_dict.items():
+            logger.error(f'{tile}: {error}')
 
-    logger.success(f'The masks were written in the folder {os.path.join(IMAGE_FOLDER, "mask")}.')
\ No newline at end of file
+    logger.success(f'The masks were written in the folder {output_dir}.')
@@ -8,8 +8,9 @@ import geopandas as gpd
 import numpy as np
 import pandas as pd
 import json
+from joblib import Parallel, delayed
 
-sys.path.insert(0, '.')
+sys.path.insert(0, os.path.abspath('.'))    # absolute path for the worker processes started after the change of working directory
 import functions.metrics as metrics
 import functions.misc as misc
 from functions.constants import DONE_MSG
@@ -18,6 +19,64 @@ from loguru import logger
 logger = misc.format_logger(logger)
 
 
+def merge_adjacent_detections(detections_gdf, tiles_gdf, distance, merge_mode='global', merge_engine='unary_union'):
+    """Merge overlapping and adjacent detections of a given year and attribute them a class and a score
+
+    Args:
+        detections_gdf (GeoDataFrame): detections of a given year
+        tiles_gdf (GeoDataFrame): tiles on which the detections were made
+        distance (float): distance used as a buffer to merge close polygons together
+        merge_mode (str): 'global' to merge all the polygons not contained in a tile, 'seam' to merge only the ones crossing tile edges. Defaults to 'global'.
+        merge_engine (str): engine used to merge overlapping polygons, 'unary_union', 'graph' or 'partitioned'. Defaults to 'unary_union'.
+
+    Returns:
+        GeoDataFrame: merged detections
+    """
+
+    # Merge overlapping polygons
+    detections_merge_overlap_poly_gdf = misc.merge_polygons(detections_gdf, id_name='det_id', engine=merge_engine)
+
+    detections_buffer_gdf = detections_merge_overlap_poly_gdf.copy()
+    detections_buffer_gdf['geometry'] = detections_buffer_gdf.geometry.buffer(distance, join_style='mitre')
+
+    if merge_mode == 'seam':
+        # Merge only the polygons crossing tile edges, the ones within a tile are kept as is
+        detections_overlap_tiles_gdf, detections_within_tiles_gdf = misc.merge_seam_polygons(detections_buffer_gdf, tiles_gdf)
+    else:
+        # Saves the id of polygons contained entirely within the tile (no merging with adjacent tiles), to avoid merging them if they are at a distance of less than thd  
+        detections_tiles_join_gdf = gpd.sjoin(tiles_gdf, detections_buffer_gdf, how='left', predicate='contains')
+        remove_det_list = detections_tiles_join_gdf.det_id.unique().tolist()
+
+        detections_within_tiles_gdf = gpd.GeoDataFrame()
+        detections_within_tiles_gdf = detections_buffer_gdf[detections_buffer_gdf.det_id.isin(remove_det_list)].drop_duplicates(subset=['det_id'], ignore_index=True)
+
+        # Merge adjacent polygons between tiles
+        detections_overlap_tiles_gdf = gpd.GeoDataFrame()
+        detections_overlap_tiles_gdf = detections_buffer_gdf[~detections_buffer_gdf.det_id.isin(remove_det_list)].drop_duplicates(subset=['det_id'], ignore_index=True)
+        detections_overlap_tiles_gdf = misc.merge_polygons(detections_overlap_tiles_gdf, engine=merge_engine)
+
+    # Concat polygons contained within a tile and the merged ones
+    detections_merge_gdf = pd.concat([detections_overlap_tiles_gdf, detections_within_tiles_gdf], axis=0, ignore_index=True)
+    detections_merge_gdf['geometry'] = detections_merge_gdf.geometry.buffer(-distance, join_style='mitre')
+    detections_merge_gdf = detections_merge_gdf.explode(ignore_index=True)
+    detections_merge_gdf['id'] = detections_merge_gdf.index
+
+    # Spatially join merged detection with raw ones to retrieve relevant information (score, area,...)
+    # Select the class of the largest polygon -> To Do: compute a parameter dependant of the area and the score
+    # Score averaged over all the detection polygon (even if the class is different from the selected one)
+    detections_join_gdf = gpd.sjoin(detections_merge_gdf, detections_gdf, how='inner', predicate='intersects')
+
+    attributes_df = misc.attribute_merged_detections(detections_join_gdf, detections_merge_gdf.id)
+    detections_merge_gdf['det_class'] = attributes_df.det_class.to_numpy()
+    detections_merge_gdf['score'] = attributes_df.score.to_numpy()
+
+    detections_merge_gdf = pd.merge(detections_merge_gdf, detections_join_gdf[
+        ['id', 'dataset', 'year_det']], 
+        on='id')
+
+    return detections_merge_gdf
+
+
 if __name__ == "__main__":
 
     # Chronometer
@@ -41,11 +100,23 @@ if __name__ == "__main__":
     FILTER_BUILDINGS = cfg['filter_buildings']['enable']
     BUILDINGS_SHP = cfg['filter_buildings']['buildings_shp']
     DISTANCE = cfg['distance']
+    MERGE_MODE = cfg['merge_mode'] if 'merge_mode' in cfg.keys() else 'global'
+    MERGE_ENGINE = cfg['merge_engine'] if 'merge_engine' in cfg.keys() else 'unary_union'
+    N_JOBS = cfg['n_jobs'] if 'n_jobs' in cfg.keys() else 1
     SCORE_THD = cfg['score_threshold']
     IOU_THD = cfg['iou_threshold']
     AREA_THD = cfg['area_threshold'] if 'area_threshold' in cfg.keys() else None
     ASSESS = cfg['assess']['enable']
     METHOD = cfg['assess']['metrics_method']
+    SCORE_SWEEP = cfg['assess']['score_sweep'] if 'score_sweep' in cfg['assess'].keys() else False
+    IOU_THD_LIST = cfg['assess']['iou_thresholds'] if 'iou_thresholds' in cfg['assess'].keys() else []
+    BOOTSTRAP = cfg['assess']['bootstrap']['enable'] if 'bootstrap' in cfg['assess'].keys() else False
+    if BOOTSTRAP:
+        NB_RESAMPLES = cfg['assess']['bootstrap']['nb_resamples'] if 'nb_resamples' in cfg['assess']['bootstrap'].keys() else 1000
+        CONFIDENCE_LEVEL = cfg['assess']['bootstrap']['confidence_level'] if 'confidence_level' in cfg['assess']['bootstrap'].keys() else 0.95
+        SEED = cfg['assess']['bootstrap']['seed'] if 'seed' in cfg['assess']['bootstrap'].keys() else None
+    METRICS_BY_TILE = cfg['assess']['metrics_by_tile'] if 'metrics_by_tile' in cfg['assess'].keys() else False
+    REGIONS = cfg['assess']['regions'] if 'regions' in cfg['assess'].keys() else {}
 
     os.chdir(WORKING_DIR)
     logger.info(f'Working directory set to {WORKING_DIR}')
@@ -74,21 +145,22 @@ if __name__ == "__main__":
         detections_gdf['year_det'] = detections_gdf.year_det.astype(int)
     logger.success(f"{DONE_MSG} {len(detections_gdf)} features were found.")
     
-    # Filter dataframe by score value
-    detections_score_gdf = detections_gdf[detections_gdf.score > SCORE_THD]
-    sc = len(detections_score_gdf)
-    logger.info(f"{len(detections_gdf) - sc} detections were removed by score filtering (score threshold = {SCORE_THD})")
-    detections_gdf = detections_score_gdf.copy()
-
     if FILTER_BUILDINGS:
         buildings_gdf = gpd.read_file(BUILDINGS_SHP).to_crs(2056) 
         left_join = gpd.sjoin(detections_gdf, buildings_gdf, how='left', predicate='intersects', lsuffix='det', rsuffix='building')
-        detections_gdf = left_join[left_join.id.notnull()].copy().drop(columns=['index_building']).drop_duplicates()
-        detections_gdf.drop(
-        columns=buildings_gdf.drop(columns='geometry').columns.to_list(), 
-        errors='ignore', 
-        inplace=True
+        detections_gdf = left_join[left_join.id.notnull()].drop(
+            columns=['index_building'] + buildings_gdf.drop(columns='geometry').columns.to_list(), 
+            errors='ignore'
         )
+        # A detection intersecting several buildings appears once per building
+        detections_gdf = detections_gdf.drop_duplicates(subset=['det_id'])
+
+    # Filter dataframe by score value, after the buildings filter so that the score sweep sees the same detections
+    raw_detections_gdf = detections_gdf
+    detections_score_gdf = detections_gdf[detections_gdf.score > SCORE_THD]
+    sc = len(detections_score_gdf)
+    logger.info(f"{len(detections_gdf) - sc} detections were removed by score filtering (score threshold = {SCORE_THD})")
+    detections_gdf = detections_score_gdf.copy()
 
     # get classe ids
     filepath = open(os.path.join('category_ids.json'))
@@ -104,66 +176,24 @@ if __name__ == "__main__":
     id_classes = range(len(categories_json))
 
     # Merge features
-    logger.info(f"Merge adjacent polygons overlapping tiles with a buffer of {DISTANCE} m...")
-    detections_year = gpd.GeoDataFrame()
+    logger.info(f"Merge adjacent polygons overlapping tiles with a buffer of {DISTANCE} m ({MERGE_MODE} mode)...")
 
-    # Process detection by year
+    # Process detections by year and, within a year, by spatially independent partitions
+    # Mitre joins extend the buffer up to 5 times the distance (default mitre limit)
+    partitions_list = []
     for year in detections_gdf.year_det.unique():
-        detections_gdf = detections_gdf.copy()
         detections_by_year_gdf = detections_gdf[detections_gdf['year_det']==year]
-
-        # Merge overlapping polygons
-        detections_merge_overlap_poly_gdf = misc.merge_polygons(detections_by_year_gdf, id_name='det_id')
-
-        # Saves the id of polygons contained entirely within the tile (no merging with adjacent tiles), to avoid merging them if they are at a distance of less than thd  
-        detections_buffer_gdf = detections_merge_overlap_poly_gdf.copy()
-        detections_buffer_gdf['geometry'] = detections_buffer_gdf.geometry.buffer(DISTANCE, join_style='mitre')
-        detections_tiles_join_gdf = gpd.sjoin(tiles_gdf, detections_buffer_gdf, how='left', predicate='contains')
-        remove_det_list = detections_tiles_join_gdf.det_id.unique().tolist()
-        
-        detections_within_tiles_gdf = gpd.GeoDataFrame()
-        detections_within_tiles_gdf = detections_buffer_gdf[detections_buffer_gdf.det_id.isin(remove_det_list)].drop_duplicates(subset=['det_id'], ignore_index=True)
-
-        # Merge adjacent polygons between tiles
-        detections_overlap_tiles_gdf = gpd.GeoDataFrame()
-        detections_overlap_tiles_gdf = detections_buffer_gdf[~detections_buffer_gdf.det_id.isin(remove_det_list)].drop_duplicates(subset=['det_id'], ignore_index=True)
-        detections_overlap_tiles_gdf = misc.merge_polygons(detections_overlap_tiles_gdf)
-    
-        # Concat polygons contained within a tile and the merged ones
-        detections_merge_gdf = pd.concat([detections_overlap_tiles_gdf, detections_within_tiles_gdf], axis=0, ignore_index=True)
-        detections_merge_gdf['geometry'] = detections_merge_gdf.geometry.buffer(-DISTANCE, join_style='mitre')
-        detections_merge_gdf = detections_merge_gdf.explode(ignore_index=True)
-        detections_merge_gdf['id'] = detections_merge_gdf.index
-
-        # Spatially join merged detection with raw ones to retrieve relevant information (score, area,...)
-        # Select the class of the largest polygon -> To Do: compute a parameter dependant of the area and the score
-        # Score averaged over all the detection polygon (even if the class is different from the selected one)
-        detections_join_gdf = gpd.sjoin(detections_merge_gdf, detections_by_year_gdf, how='inner', predicate='intersects')
-
-        det_class_all = []
-        det_score_all = []
-
-        for id in detections_merge_gdf.id.unique():
-            detections_by_year_gdf = detections_join_gdf.copy()
-            detections_by_year_gdf = detections_by_year_gdf[(detections_by_year_gdf['id']==id)]
-            detections_by_year_gdf = detections_by_year_gdf.rename(columns={'score_left': 'score'})
-            det_score_all.append(detections_by_year_gdf['score'].mean())
-            detections_by_year_gdf = detections_by_year_gdf.dissolve(by='det_class', aggfunc='sum', as_index=False)
-            if len(detections_by_year_gdf) > 0:
-                detections_by_year_gdf['det_class'] = detections_by_year_gdf.loc[detections_by_year_gdf['area']==detections_by_year_gdf['area'].max(), 
-                                                                'det_class'].iloc[0]    
-                det_class = detections_by_year_gdf['det_class'].drop_duplicates().tolist()
-            else:
-                det_class = [0]
-            det_class_all.append(det_class[0])
-
-        detections_merge_gdf['det_class'] = det_class_all
-        detections_merge_gdf['score'] = det_score_all
-
-        detections_merge_gdf = pd.merge(detections_merge_gdf, detections_join_gdf[
-            ['id', 'dataset', 'year_det']], 
-            on='id')
-        detections_year = pd.concat([detections_year, detections_merge_gdf])
+        partitions_list.extend([
+            detections_by_year_gdf.iloc[partition] 
+            for partition in misc.get_spatial_partitions(detections_by_year_gdf, N_JOBS, margin=5*DISTANCE)
+        ])
+    logger.info(f"{len(partitions_list)} partition(s) to process with {N_JOBS} job(s)")
+
+    detections_merge_list = Parallel(n_jobs=N_JOBS)(
+        delayed(merge_adjacent_detections)(detections_partition_gdf, tiles_gdf, DISTANCE, MERGE_MODE, MERGE_ENGINE) 
+        for detections_partition_gdf in partitions_list
+    )
+    detections_year = pd.concat(detections_merge_list)
 
     detections_year['det_category'] = [
         categories_info_df.loc[categories_info_df.label_class==det_class+1, 'CATEGORY'].iloc[0] 
@@ -172,7 +202,7 @@ if __name__ == "__main__":
     ] 
 
     # Remove duplicate detection for a given year
-    detections_merge_gdf = detections_year.drop_duplicates(subset=['geometry', 'year_det'])
+    detections_merge_gdf = misc.drop_duplicate_geometries(detections_year, subset=['year_det'])
     
     td = len(detections_merge_gdf)
     logger.info(f"... {td} detections remaining after union of the shapes.")
@@ -190,14 +220,35 @@ if __name__ == "__main__":
         labels_gdf['CATEGORY'] = labels_gdf.CATEGORY.astype(str)
         labels_w_id_gdf = labels_gdf.merge(categories_info_df, on='CATEGORY', how='left')
 
+        if SCORE_SWEEP:
+            logger.info('Get metrics of the detections before merging for every score threshold...')
+            curve_df, sweep_summary_df = metrics.get_score_sweep(raw_detections_gdf, labels_w_id_gdf, id_classes, IOU_THD, AREA_THD)
+            category_dict = dict(zip(categories_info_df.label_class - 1, categories_info_df.CATEGORY))
+
+            file_to_write = os.path.join('score_threshold_sweep.csv')
+            curve_df['category'] = curve_df['class'].map(category_dict).fillna('all')
+            curve_df[['class', 'category', 'threshold', 'TP', 'FP', 'FN', 'precision', 'recall', 'f1']].to_csv(file_to_write, index=False)
+            written_files.append(file_to_write)
+
+            file_to_write = os.path.join('score_threshold_sweep_summary.csv')
+            sweep_summary_df['category'] = sweep_summary_df['class'].map(category_dict).fillna('all')
+            sweep_summary_df[['class', 'category', 'AP', 'best_threshold', 'precision', 'recall', 'f1']].to_csv(file_to_write, index=False)
+            written_files.append(file_to_write)
+
+            best_f1_row = sweep_summary_df[sweep_summary_df['class']=='all'].iloc[0]
+            logger.info(f"AP = {best_f1_row.AP:.3f}, best f1 = {best_f1_row.f1:.3f} at a score threshold of {best_f1_row.best_threshold:.3f} (before merging)")
+
         logger.info('Tag detections and get metrics...')
 
         metrics_dict = {}
         metrics_dict_by_cl = []
         metrics_cl_df_dict = {}
 
-        tp_gdf, fp_gdf, fn_gdf, mismatched_class_gdf, small_poly_gdf = metrics.get_fractional_sets(
-            detections_merge_gdf, labels_w_id_gdf, IOU_THD, AREA_THD)
+        # Intersections between detections and labels are computed once for all the IoU thresholds
+        iou_thresholds = sorted(set([IOU_THD] + IOU_THD_LIST))
+        fractional_sets_dict, metrics_by_iou_dict = metrics.get_metrics_by_iou(
+            detections_merge_gdf, labels_w_id_gdf, iou_thresholds, id_classes, METHOD, AREA_THD)
+        tp_gdf, fp_gdf, fn_gdf, mismatched_class_gdf, small_poly_gdf = fractional_sets_dict[IOU_THD]
 
         tp_gdf['tag'] = 'TP'
         fp_gdf['tag'] = 'FP'
@@ -214,7 +265,7 @@ if __name__ == "__main__":
             for det_class in tagged_dets_gdf.det_class.to_numpy()
         ] 
 
-        tp_k, fp_k, fn_k, p_k, r_k, f1_k, accuracy, precision, recall, f1 = metrics.get_metrics(tp_gdf, fp_gdf, fn_gdf, mismatched_class_gdf, id_classes, method=METHOD)
+        tp_k, fp_k, fn_k, p_k, r_k, f1_k, accuracy, precision, recall, f1 = metrics_by_iou_dict[IOU_THD]
         logger.info(f'Detection score threshold = {SCORE_THD}')
         logger.info(f'accuracy = {accuracy:.3f}')
         logger.info(f'Method = {METHOD}: precision = {precision:.3f}, recall = {recall:.3f}, f1 = {f1:.3f}')
@@ -223,11 +274,25 @@ if __name__ == "__main__":
         feature = os.path.join(f'tagged_merged_detections_at_{SCORE_THD}_threshold.gpkg'.replace('0.', '0dot'))
         tagged_dets_gdf = tagged_dets_gdf.to_crs(2056)
         tagged_dets_gdf = tagged_dets_gdf.rename(columns={'CATEGORY': 'label_category'}, errors='raise')
+
+        # Tag the detections and labels with the tile and the regions in which they lie
+        if 'year_tile' in tiles_gdf.keys() and 'year_det' in tagged_dets_gdf.keys():
+            tagged_years = tagged_dets_gdf.year_det.fillna(tagged_dets_gdf.year_label) if 'year_label' in tagged_dets_gdf.keys() else tagged_dets_gdf.year_det
+            tagged_dets_gdf['tile_id'] = pd.concat([
+                misc.get_zone_ids(tagged_dets_gdf[tagged_years==year], tiles_gdf[tiles_gdf.year_tile==year], 'id')
+                for year in tagged_years.unique()
+            ])
+        else:
+            tagged_dets_gdf['tile_id'] = misc.get_zone_ids(tagged_dets_gdf, tiles_gdf, 'id')
+        for region_name, region_info in REGIONS.items():
+            regions_gdf = gpd.read_file(region_info['file']).to_crs(2056)
+            tagged_dets_gdf[region_name] = misc.get_zone_ids(tagged_dets_gdf, regions_gdf, region_info['attribute'])
+
         if 'year_label' in tagged_dets_gdf.keys() and 'year_det' in tagged_dets_gdf.keys():
-            tagged_dets_gdf[['geometry', 'det_id', 'score', 'tag', 'label_class', 'label_category', 'year_label', 'det_class', 'det_category', 'year_det']]\
+            tagged_dets_gdf[['geometry', 'det_id', 'score', 'tag', 'label_class', 'label_category', 'year_label', 'det_class', 'det_category', 'year_det', 'tile_id'] + list(REGIONS.keys())]\
                 .to_file(feature, driver='GPKG', index=False)
         else:
-            tagged_dets_gdf[['geometry', 'det_id', 'score', 'tag', 'label_class', 'label_category', 'det_class', 'det_category']]\
+            tagged_dets_gdf[['geometry', 'det_id', 'score', 'tag', 'label_class', 'label_category', 'det_class', 'det_category', 'tile_id'] + list(REGIONS.keys())]\
             .to_file(feature, driver='GPKG', index=False)
         written_files.append(feature)
 
@@ -261,6 +326,59 @@ if __name__ == "__main__":
         ].sort_values(by=['class']).to_csv(file_to_write, index=False)
         written_files.append(file_to_write)
 
+        # Save the confusion matrix with the label classes as rows and the detection classes as columns
+        confusion_matrix_df = metrics.get_confusion_matrix(tp_gdf, fp_gdf, fn_gdf, mismatched_class_gdf, id_classes)
+        category_dict = dict(zip(categories_info_df.label_class - 1, categories_info_df.CATEGORY))
+        confusion_matrix_df = confusion_matrix_df.rename(index=category_dict, columns=category_dict)
+
+        file_to_write = os.path.join('confusion_matrix_merged_detections.csv')
+        confusion_matrix_df.to_csv(file_to_write)
+        written_files.append(file_to_write)
+
+        # Save the metrics by tile and by region
+        for group_name in (['tile_id'] if METRICS_BY_TILE else []) + list(REGIONS.keys()):
+            metrics_by_group_df = metrics.get_metrics_by_group(tagged_dets_gdf, id_classes, group_name, METHOD)
+            metrics_by_group_df = metrics_by_group_df.sort_values(by=['f1', group_name], ignore_index=True)
+            logger.info(f'{len(metrics_by_group_df)} groups by {group_name}, lowest f1 score: {metrics_by_group_df.f1.iloc[0]:.3f} for {metrics_by_group_df[group_name].iloc[0]}')
+
+            file_to_write = os.path.join(f"metrics_by_{group_name.replace('_id', '')}_merged_detections.csv")
+            metrics_by_group_df.to_csv(file_to_write, index=False)
+            written_files.append(file_to_write)
+
+        # Save the confidence intervals of the metrics, resampling the tiles
+        if BOOTSTRAP:
+            logger.info(f'Bootstrap the metrics over the tiles with {NB_RESAMPLES} resamples...')
+            bootstrap_df = metrics.get_bootstrap_intervals(
+                tagged_dets_gdf, id_classes, 'tile_id', NB_RESAMPLES, CONFIDENCE_LEVEL, METHOD, N_JOBS, SEED
+            )
+            for metric in bootstrap_df.itertuples():
+                logger.info(f'{metric.metric} = {metric.value:.3f}, {CONFIDENCE_LEVEL:.0%} CI: [{metric.lower_bound:.3f}, {metric.upper_bound:.3f}]')
+
+            file_to_write = os.path.join('metrics_bootstrap_merged_detections.csv')
+            bootstrap_df.to_csv(file_to_write, index=False)
+            written_files.append(file_to_write)
+
+        # Save the metrics for each IoU threshold
+        if IOU_THD_LIST:
+            metrics_by_iou_list = []
+            for iou_thd in IOU_THD_LIST:
+                tp_k_iou, fp_k_iou, fn_k_iou, _, _, _, accuracy_iou, precision_iou, recall_iou, f1_iou = metrics_by_iou_dict[iou_thd]
+                metrics_by_iou_list.append({
+                    'iou_threshold': iou_thd,
+                    'TP': sum(tp_k_iou.values()),
+                    'FP': sum(fp_k_iou.values()),
+                    'FN': sum(fn_k_iou.values()),
+                    'accuracy': accuracy_iou,
+                    'precision': precision_iou,
+                    'recall': recall_iou,
+                    'f1': f1_iou,
+                })
+                logger.info(f'IoU threshold = {iou_thd}: precision = {precision_iou:.3f}, recall = {recall_iou:.3f}, f1 = {f1_iou:.3f}')
+
+            file_to_write = os.path.join('metrics_by_iou_threshold_merged_detections.csv')
+            pd.DataFrame.from_records(metrics_by_iou_list).to_csv(file_to_write, index=False)
+            written_files.append(file_to_write)
+
     # Save processed results
     feature = os.path.join(f'merged_detections_at_{SCORE_THD}_threshold.gpkg'.replace('0.', '0dot'))
     if FILTER_BUILDINGS:
@@ -6,12 +6,18 @@ import sys
 import time
 import argparse
 import yaml
-import re
 
 import geopandas as gpd
 import morecantile
+from morecantile.models import LL_EPSILON
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
+import rasterio
+import shapely
+from rasterio.features import rasterize
+from rasterio.transform import from_origin
+from scipy.ndimage import binary_dilation
 from shapely.geometry import Polygon
 
 sys.path.insert(0, '.')
@@ -22,47 +28,47 @@ from loguru import logger
 logger = misc.format_logger(logger)
 
 
-def add_tile_id(row):
-    """Attribute tile id
+def aoi_tiles_generator(aoi_gdf, zoom, chunk_size=100000, tms='WebMercatorQuad'):
+    """Yield the XYZ tiles intersecting an AoI by chunks of tile rows, so that the tiles of the whole AoI are never in memory at once.
+    The rows outside of the AoI parts are skipped and the tiles of each chunk are filtered with the prepared AoI geometries.
 
     Args:
-        row (DataFrame): row of a given df
+        aoi_gdf (GeoDataFrame): AoI polygons in EPSG:4326
+        zoom (int): zoom level of the tiles
+        chunk_size (int): approximate number of candidate tiles in a chunk. Defaults to 100000.
+        tms (str): identifier of the tile matrix set. Defaults to 'WebMercatorQuad'.
 
-    Returns:
-        DataFrame: row with addition 'id' column
+    Yields:
+        GeoDataFrame: tiles of a chunk intersecting the AoI
     """
 
-    re_search = re.search('(x=(?P<x>\d*), y=(?P<y>\d*), z=(?P<z>\d*))', row.title)
-    if 'year' in row.keys():
-        row['id'] = f"({row.year}, {re_search.group('x')}, {re_search.group('y')}, {re_search.group('z')})"
-    else:
-        row['id'] = f"({re_search.group('x')}, {re_search.group('y')}, {re_search.group('z')})"
- 
-    return row
+    aoi_geoms = aoi_gdf.geometry.to_numpy()
+    shapely.prepare(aoi_geoms)
+    aoi_tree = shapely.STRtree(aoi_geoms)
+    parts_xmin, parts_xmax, parts_ymin, parts_ymax = get_tile_ranges(aoi_gdf.bounds, zoom, tms)
+    rows_by_chunk = max(1, chunk_size // (parts_xmax.max() - parts_xmin.min() + 1))
 
+    for chunk_start in range(parts_ymin.min(), parts_ymax.max() + 1, rows_by_chunk):
+        chunk_end = chunk_start + rows_by_chunk - 1
 
-def aoi_tiling(gdf, tms='WebMercatorQuad'):
-    """Tiling of an AoI
+        # Restrict the chunk to the tile range of the AoI parts it crosses
+        crossed_parts = (parts_ymin <= chunk_end) & (parts_ymax >= chunk_start)
+        if not crossed_parts.any():
+            continue
+        chunk_ymin = max(chunk_start, parts_ymin[crossed_parts].min())
+        chunk_ymax = min(chunk_end, parts_ymax[crossed_parts].max())
 
-    Args:
-        gdf (GeoDataFrame): gdf containing all the bbox boundary coordinates
+        _, x, y = enumerate_tiles(
+            parts_xmin[crossed_parts].min(keepdims=True), parts_xmax[crossed_parts].max(keepdims=True), np.array([chunk_ymin]), np.array([chunk_ymax])
+        )
+        tiles_gdf = get_tiles_gdf(x, y, zoom, tms)
 
-    Returns:
-        Geodataframe: gdf containing the tiles shape of the bbox of the AoI
-    """
-
-    # Grid definition
-    tms = morecantile.tms.get(tms)    # epsg:3857
+        tile_idx, aoi_idx = aoi_tree.query(tiles_gdf.geometry.to_numpy())
+        intersecting = shapely.intersects(aoi_geoms[aoi_idx], tiles_gdf.geometry.to_numpy()[tile_idx])
+        tiles_gdf = tiles_gdf.iloc[np.unique(tile_idx[intersecting])]
 
-    tiles_all = [] 
-    for boundary in gdf.itertuples():
-        coords = (boundary.minx, boundary.miny, boundary.maxx, boundary.maxy)      
-        tiles = gpd.GeoDataFrame.from_features([tms.feature(x, projected=False) for x in tms.tiles(*coords, zooms=[ZOOM_LEVEL])]) 
-        tiles.set_crs(epsg=4326, inplace=True)
-        tiles_all.append(tiles)
-    tiles_all_gdf = gpd.GeoDataFrame(pd.concat(tiles_all, ignore_index=True))
-
-    return tiles_all_gdf
+        if not tiles_gdf.empty:
+            yield tiles_gdf
 
 
 def assert_year(gdf1, gdf2, ds, year=None):
@@ -116,15 +122,249 @@ def bbox(bounds):
                     [minx, maxy]])
 
 
-def prepare_labels(shpfile, written_files, category=None, class_selection=None, canton_selection=None, prefix=''):
+def dry_run(shpfile, fp_shpfile=None, ept_shpfile=None, ept_type=None, ept_nb_tiles=None, zoom=20, tile_size=256, 
+            category=None, class_selection=None, canton_selection=None):
+    """Estimate the number of tiles and the size of the outputs from the tile ranges of the datasets, without building any tile.
+    The tiles of the bboxes are counted, which is an upper bound of the tiles intersecting the labels and the AoI.
+
+    Args:
+        shpfile (str): path to the GT labels
+        fp_shpfile (str): path to the FP labels. Defaults to None.
+        ept_shpfile (str): path to the AoI or to the tiles of the empty tiles. Defaults to None.
+        ept_type (str): type of the empty tiles file, 'aoi' or 'shp'. Defaults to None.
+        ept_nb_tiles (int): number of empty tiles sampled in the AoI. Defaults to None.
+        zoom (int): zoom level of the tiles. Defaults to 20.
+        tile_size (int): size of the images in pixels per side. Defaults to 256.
+        category (str): column with the label classes. Defaults to None.
+        class_selection (list): selected classes. Defaults to None.
+        canton_selection (list): selected cantons. Defaults to None.
+
+    Returns:
+        int: estimated number of tiles
+    """
+
+    logger.info(f"Dry run: count the tiles at zoom level {zoom} from their indices...")
+
+    labels_4326_gdf, _ = prepare_labels(shpfile, [], category=category, class_selection=class_selection, canton_selection=canton_selection, write_file=False)
+    tile_keys = get_tile_keys(labels_4326_gdf, zoom)
+    logger.info(f"- GT labels: at most {len(tile_keys)} tiles")
+
+    if fp_shpfile:
+        fp_labels_4326_gdf, _ = prepare_labels(fp_shpfile, [], category=category, class_selection=class_selection, canton_selection=canton_selection, write_file=False)
+        fp_tile_keys = get_tile_keys(fp_labels_4326_gdf, zoom)
+        logger.info(f"- FP labels: at most {len(fp_tile_keys)} tiles, {len(np.setdiff1d(fp_tile_keys, tile_keys))} of them without GT labels")
+        tile_keys = np.union1d(tile_keys, fp_tile_keys)
+
+    nb_empty_tiles = 0
+    if ept_shpfile:
+        ept_4326_gdf = gpd.read_file(ept_shpfile).to_crs(epsg=4326)
+        if ept_type == 'aoi':
+            nb_empty_tiles = len(get_tile_keys(ept_4326_gdf.drop(columns='year', errors='ignore'), zoom))
+            nb_empty_tiles = min(nb_empty_tiles, ept_nb_tiles) if ept_nb_tiles else nb_empty_tiles
+        else:
+            nb_empty_tiles = len(ept_4326_gdf)
+        logger.info(f"- Empty tiles: at most {nb_empty_tiles} tiles")
+
+    nb_tiles = len(tile_keys) + nb_empty_tiles
+    logger.info(f"Total: at most {nb_tiles} tiles")
+
+    # Size of one tile feature as written in the GeoJSON file
+    tile_gdf = get_tiles_gdf([2**zoom - 1], [2**zoom - 1], zoom)
+    tile_gdf['year'] = 2000
+    tile_gdf['id'] = f'(2000, {2**zoom - 1}, {2**zoom - 1}, {zoom})'
+    feature_size = len(tile_gdf.to_json().encode()) - len('{"type": "FeatureCollection", "features": []}')
+    logger.info(f"- Projected size of tiles.geojson: {nb_tiles * feature_size / 1e6:.1f} MB")
+    logger.info(f"- Projected volume of the images downloaded by generate_tilesets.py: {nb_tiles * tile_size**2 * 3 / 1e9:.2f} GB (uncompressed RGB, {tile_size} x {tile_size} px)")
+
+    return nb_tiles
+
+
+def enumerate_tiles(xmin, xmax, ymin, ymax):
+    """Enumerate the tiles of tile ranges with integer arithmetic
+
+    Args:
+        xmin (array): minimum x index of each range
+        xmax (array): maximum x index of each range
+        ymin (array): minimum y index of each range
+        ymax (array): maximum y index of each range
+
+    Returns:
+        tuple: arrays with the range index, the x and the y indices of each tile
+    """
+
+    nb_x = xmax - xmin + 1
+    nb_tiles = nb_x * (ymax - ymin + 1)
+    range_idx = np.repeat(np.arange(len(nb_tiles)), nb_tiles)
+    tile_idx = np.arange(nb_tiles.sum()) - np.repeat(np.cumsum(nb_tiles) - nb_tiles, nb_tiles)
+    x = xmin[range_idx] + tile_idx % nb_x[range_idx]
+    y = ymin[range_idx] + tile_idx // nb_x[range_idx]
+
+    return range_idx, x, y
+
+
+def get_tile_keys(gdf, zoom, tms='WebMercatorQuad'):
+    """Get the tiles covering the bbox of each geometry as unique int64 keys, without building the tiles.
+    The key is year * 4^zoom + x * 2^zoom + y, the year being included only if the gdf has a year column.
+
+    Args:
+        gdf (GeoDataFrame): geometries in EPSG:4326
+        zoom (int): zoom level of the tiles
+        tms (str): identifier of the tile matrix set. Defaults to 'WebMercatorQuad'.
+
+    Returns:
+        array: unique tile keys
+    """
+
+    range_idx, x, y = enumerate_tiles(*get_tile_ranges(gdf.bounds, zoom, tms))
+    tile_keys = x * 2**zoom + y
+    if 'year' in gdf.keys():
+        tile_keys += gdf.year.to_numpy().astype(np.int64)[range_idx] * 4**zoom
+
+    return np.unique(tile_keys)
+
+
+def get_tile_ranges(gdf, zoom, tms='WebMercatorQuad'):
+    """Get the range of the XYZ tiles covering each bbox, like morecantile's tms.tiles but for all the bboxes at once
+
+    Args:
+        gdf (GeoDataFrame): gdf containing the bbox boundary coordinates in EPSG:4326
+        zoom (int): zoom level of the tiles
+        tms (str): identifier of the tile matrix set. Defaults to 'WebMercatorQuad'.
+
+    Returns:
+        tuple: arrays of the minimum and maximum x and y tile indices of each bbox
+    """
+
+    tms = morecantile.tms.get(tms)
+    matrix = tms.matrix(zoom)
+    origin_x, _, _, origin_y = tms.xy_bounds(morecantile.Tile(0, 0, zoom))
+
+    # Clamp the bbox to the TMS limits, the epsilon keeps out the tiles only touching the bbox edges
+    west = np.maximum(tms.bbox.left, gdf.minx.to_numpy()) + LL_EPSILON
+    south = np.maximum(tms.bbox.bottom, gdf.miny.to_numpy()) + LL_EPSILON
+    east = np.minimum(tms.bbox.right, gdf.maxx.to_numpy()) - LL_EPSILON
+    north = np.minimum(tms.bbox.top, gdf.maxy.to_numpy()) - LL_EPSILON
+
+    corners = gpd.GeoSeries(gpd.points_from_xy(np.concatenate((west, east)), np.concatenate((north, south))), crs=4326).to_crs(tms.crs.to_epsg())
+    xtile = np.floor((corners.x.to_numpy() - origin_x) / float(matrix.cellSize * matrix.tileWidth))
+    ytile = np.floor((origin_y - corners.y.to_numpy()) / float(matrix.cellSize * matrix.tileHeight))
+    xtile = np.clip(xtile, 0, matrix.matrixWidth - 1).astype(np.int64).reshape(2, -1)
+    ytile = np.clip(ytile, 0, matrix.matrixHeight - 1).astype(np.int64).reshape(2, -1)
+
+    return xtile.min(axis=0), xtile.max(axis=0), ytile.min(axis=0), ytile.max(axis=0)
+
+
+def get_tiles_gdf(x, y, zoom, tms='WebMercatorQuad'):
+    """Build the geometries of XYZ tiles in EPSG:4326, like morecantile's tms.feature but for all the tiles at once
+
+    Args:
+        x (array): x indices of the tiles
+        y (array): y indices of the tiles
+        zoom (int): zoom level of the tiles
+        tms (str): identifier of the tile matrix set. Defaults to 'WebMercatorQuad'.
+
+    Returns:
+        GeoDataFrame: tiles with their title and their x, y and z indices
+    """
+
+    tms = morecantile.tms.get(tms)
+    matrix = tms.matrix(zoom)
+    origin_x, _, _, origin_y = tms.xy_bounds(morecantile.Tile(0, 0, zoom))
+
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    left = origin_x + x * matrix.cellSize * matrix.tileWidth
+    right = origin_x + (x + 1) * matrix.cellSize * matrix.tileWidth
+    top = origin_y - y * matrix.cellSize * matrix.tileHeight
+    bottom = origin_y - (y + 1) * matrix.cellSize * matrix.tileHeight
+
+    corners = gpd.GeoSeries(gpd.points_from_xy(np.concatenate((left, right)), np.concatenate((bottom, top))), crs=tms.crs.to_epsg()).to_crs(4326)
+    west, east = corners.x.to_numpy().reshape(2, -1)
+    south, north = corners.y.to_numpy().reshape(2, -1)
+    rings = np.stack([
+        np.column_stack((west, south)), np.column_stack((west, north)), np.column_stack((east, north)), 
+        np.column_stack((east, south)), np.column_stack((west, south))
+    ], axis=1)
+
+    tiles_gdf = gpd.GeoDataFrame(
+        {
+            'title': 'XYZ tile Tile(x=' + pd.Series(x).astype(str) + ', y=' + pd.Series(y).astype(str) + f', z={zoom})',
+            'x': x, 'y': y, 'z': zoom
+        }, 
+        geometry=shapely.polygons(rings), crs=4326
+    )
+
+    return tiles_gdf
+
+
+def labels_tiling(labels_gdf, zoom, tms='WebMercatorQuad', max_range_tiles=64):
+    """Get the XYZ tiles intersecting each label.
+    Labels with a large tile range are burned on a grid of one pixel per tile over their range. The touched pixels and their 
+    neighbours, as the burning can miss slivers in the corners, are the candidate tiles. The other labels take all the tiles 
+    of their range as candidates. The intersection of each label with its candidate tiles is then checked.
+
+    Args:
+        labels_gdf (GeoDataFrame): labels in EPSG:4326
+        zoom (int): zoom level of the tiles
+        tms (str): identifier of the tile matrix set. Defaults to 'WebMercatorQuad'.
+        max_range_tiles (int): maximum number of tiles in the range of a label to take them all as candidates. Defaults to 64.
+
+    Returns:
+        GeoDataFrame: one row for each tile and intersecting label, with the attributes of the tile and of the label
+    """
+
+    tms_name = tms
+    tms = morecantile.tms.get(tms)
+    matrix = tms.matrix(zoom)
+    origin_x, _, _, origin_y = tms.xy_bounds(morecantile.Tile(0, 0, zoom))
+    tile_size = matrix.cellSize * matrix.tileWidth
+
+    labels_gdf = labels_gdf.reset_index(drop=True)
+    xmin, xmax, ymin, ymax = get_tile_ranges(labels_gdf.bounds, zoom, tms_name)
+    nb_x = xmax - xmin + 1
+    nb_y = ymax - ymin + 1
+
+    # The dilated burning would cover nearly all the tiles of small or narrow ranges
+    small_range = (nb_x * nb_y <= max_range_tiles) | (nb_x < 3) | (nb_y < 3)
+    range_idx, x, y = enumerate_tiles(xmin[small_range], xmax[small_range], ymin[small_range], ymax[small_range])
+    label_idx_list = [np.flatnonzero(small_range)[range_idx]]
+    x_list = [x]
+    y_list = [y]
+
+    labels_tms_geoms = labels_gdf.geometry.to_crs(tms.crs.to_epsg())
+    with rasterio.Env():
+        for label_idx in np.flatnonzero(~small_range):
+            transform = from_origin(origin_x + xmin[label_idx] * tile_size, origin_y - ymin[label_idx] * tile_size, tile_size, tile_size)
+            coverage = rasterize(
+                [labels_tms_geoms.iloc[label_idx]], out_shape=(nb_y[label_idx], nb_x[label_idx]), transform=transform, all_touched=True, dtype='uint8'
+            )
+            rows, cols = np.nonzero(binary_dilation(coverage, structure=np.ones((3, 3))))
+            label_idx_list.append(np.full(len(rows), label_idx))
+            x_list.append(xmin[label_idx] + cols)
+            y_list.append(ymin[label_idx] + rows)
+
+    pairs_df = pd.DataFrame({'index_right': np.concatenate(label_idx_list), 'x': np.concatenate(x_list), 'y': np.concatenate(y_list)})
+
+    # Build each tile once and only keep the tiles really intersecting the labels
+    tiles_gdf = get_tiles_gdf(*np.unique(pairs_df[['x', 'y']].to_numpy(), axis=0).T, zoom, tms_name)
+    tiles_labels_gdf = tiles_gdf.merge(pairs_df, on=['x', 'y'], how='inner')
+    tiles_labels_gdf = tiles_labels_gdf[
+        tiles_labels_gdf.intersects(labels_gdf.geometry.iloc[tiles_labels_gdf.index_right.to_numpy()], align=False)
+    ]
+    tiles_labels_gdf = tiles_labels_gdf.join(labels_gdf.drop(columns='geometry'), on='index_right')
+
+    return tiles_labels_gdf
+
+
+def prepare_labels(shpfile, written_files, output_dir='.', category=None, class_selection=None, canton_selection=None, prefix='', write_file=True):
 
     labels_gdf = gpd.read_file(shpfile)
     labels_gdf = misc.check_validity(labels_gdf, correct=True)
     if 'year' in labels_gdf.keys():
         labels_gdf['year'] = labels_gdf.year.astype(int)
-        labels_4326_gdf = labels_gdf.to_crs(epsg=4326).drop_duplicates(subset=['geometry', 'year'])
+        labels_4326_gdf = misc.drop_duplicate_geometries(labels_gdf.to_crs(epsg=4326), subset=['year'])
     else:
-        labels_4326_gdf = labels_gdf.to_crs(epsg=4326).drop_duplicates(subset=['geometry'])
+        labels_4326_gdf = misc.drop_duplicate_geometries(labels_gdf.to_crs(epsg=4326))
 
     nb_labels = len(labels_4326_gdf)
     logger.info(f"There are {nb_labels} polygons in {os.path.basename(shpfile)}")
@@ -148,49 +388,41 @@ def prepare_labels(shpfile, written_files, category=None, class_selection=None,
         labels_4326_gdf['CATEGORY'] = 'energy facility'
         labels_4326_gdf['SUPERCATEGORY'] = 'energy facility'
 
-    labels_filepath = os.path.join(OUTPUT_DIR, f'{prefix}labels.geojson')
-    labels_4326_gdf.to_file(labels_filepath, driver='GeoJSON')
-    written_files.append(labels_filepath)  
-    logger.success(f"{DONE_MSG} A file was written: {labels_filepath}")
+    if write_file:
+        labels_filepath = os.path.join(output_dir, f'{prefix}labels.geojson')
+        labels_4326_gdf.to_file(labels_filepath, driver='GeoJSON')
+        written_files.append(labels_filepath)  
+        logger.success(f"{DONE_MSG} A file was written: {labels_filepath}")
 
     return labels_4326_gdf, written_files
 
 
-if __name__ == "__main__":
-
-    # Start chronometer
-    tic = time.time()
-    logger.info('Starting...')
-
-    # Argument and parameter specification
-    parser = argparse.ArgumentParser(description="The script prepares the ground truth dataset to be processed by the object-detector scripts")
-    parser.add_argument('config_file', type=str, help='Framework configuration file')
-    args = parser.parse_args()
+def prepare_tiles(output_dir, zoom, shpfile, fp_shpfile=None, ept_shpfile=None, ept_type=None, ept_year=None, ept_nb_tiles=None, ept_seed=None, 
+                  category=None, class_selection=None, canton_selection=None):
+    """Prepare the labels and the tiles of a partition of the dataset, i.e. a zoom level and a selection of cantons
 
-    logger.info(f"Using {args.config_file} as config file.")
- 
-    with open(args.config_file) as fp:
-        cfg = yaml.load(fp, Loader=yaml.FullLoader)[os.path.basename(__file__)]
+    Args:
+        output_dir (str): output directory of the partition
+        zoom (int): zoom level of the tiles
+        shpfile (str): path to the GT labels
+        fp_shpfile (str): path to the FP labels. Defaults to None.
+        ept_shpfile (str): path to the AoI or to the tiles of the empty tiles. Defaults to None.
+        ept_type (str): type of the empty tiles file, 'aoi' or 'shp'. Defaults to None.
+        ept_year (int or list): year or range of years attributed to the empty tiles. Defaults to None.
+        ept_nb_tiles (int): number of empty tiles sampled in the AoI. Defaults to None.
+        ept_seed (int): seed of the empty tile sampling. Defaults to None.
+        category (str): column with the label classes. Defaults to None.
+        class_selection (list): selected classes. Defaults to None.
+        canton_selection (list): selected cantons. Defaults to None.
 
-    # Load input parameters
-    OUTPUT_DIR = cfg['output_folder']
-    SHPFILE = cfg['datasets']['shapefile']
-    FP_SHPFILE = cfg['datasets']['fp_shapefile'] if 'fp_shapefile' in cfg['datasets'].keys() else None
-    if 'empty_tiles' in cfg['datasets'].keys():
-        EPT_TYPE = cfg['datasets']['empty_tiles']['type']
-        EPT_SHPFILE = cfg['datasets']['empty_tiles']['shapefile']
-        EPT_YEAR = cfg['datasets']['empty_tiles']['year'] if 'year' in cfg['datasets']['empty_tiles'].keys() else None
-    else:
-        EPT_SHPFILE = None
-        EPT_TYPE = None
-        EPT_YEAR = None
-    CATEGORY = cfg['datasets']['category'] if 'category' in cfg['datasets'].keys() else None
-    CLASS_SELECTION = cfg['datasets']['class_selection'] if 'class_selection' in cfg['datasets'].keys() else None
-    CANTON_SELECTION = cfg['datasets']['canton_selection'] if 'canton_selection' in cfg['datasets'].keys() else None  
-    ZOOM_LEVEL = cfg['zoom_level']
+    Returns:
+        tuple: 
+            - GeoDataFrame: tiles of the partition
+            - list: written files
+    """
 
     # Create an output directory in case it doesn't exist
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
 
     written_files = []
     
@@ -198,48 +430,51 @@ if __name__ == "__main__":
 
     ## Convert datasets shapefiles into geojson format
     logger.info('Convert the label shapefiles into GeoJSON format (EPSG:4326)...')
-    labels_4326_gdf, written_files = prepare_labels(SHPFILE, written_files, CATEGORY, CLASS_SELECTION, CANTON_SELECTION)
+    labels_4326_gdf, written_files = prepare_labels(shpfile, written_files, output_dir, category, class_selection, canton_selection)
     gt_labels_4326_gdf = labels_4326_gdf[['geometry', 'CATEGORY', 'SUPERCATEGORY']].copy()
 
     # Add FP labels if it exists
-    if FP_SHPFILE:
+    if fp_shpfile:
         logger.info('Convert the FP label shapefiles into GeoJSON format (EPSG:4326)...')
-        fp_labels_4326_gdf, written_files = prepare_labels(FP_SHPFILE, written_files, CATEGORY, CLASS_SELECTION, CANTON_SELECTION, prefix='FP_')
+        fp_labels_4326_gdf, written_files = prepare_labels(fp_shpfile, written_files, output_dir, category, class_selection, canton_selection, prefix='FP_')
         labels_4326_gdf = pd.concat([labels_4326_gdf, fp_labels_4326_gdf], ignore_index=True)
 
     # Tiling of the AoI
-    logger.info("- Get the label boundaries")  
-    boundaries_df = labels_4326_gdf.bounds
-    logger.info("- Tiling of the AoI")  
-    tiles_4326_aoi_gdf = aoi_tiling(boundaries_df)
-    tiles_4326_labels_gdf = gpd.sjoin(tiles_4326_aoi_gdf, labels_4326_gdf, how='inner', predicate='intersects')
+    logger.info("- Tiling of the label footprints")  
+    tiles_4326_labels_gdf = labels_tiling(labels_4326_gdf, zoom)
 
     # Tiling of the AoI from which empty tiles will be selected
-    if EPT_SHPFILE:
-        EPT_aoi_gdf = gpd.read_file(EPT_SHPFILE)
+    if ept_shpfile:
+        EPT_aoi_gdf = gpd.read_file(ept_shpfile)
         EPT_aoi_4326_gdf = EPT_aoi_gdf.to_crs(epsg=4326)
-        assert_year(labels_4326_gdf, EPT_aoi_4326_gdf, 'empty_tiles', EPT_YEAR)
+        assert_year(labels_4326_gdf, EPT_aoi_4326_gdf, 'empty_tiles', ept_year)
         
-        if EPT_TYPE == 'aoi':
-            logger.info("- Get AoI boundaries")  
-            EPT_aoi_boundaries_df = EPT_aoi_4326_gdf.bounds
-
-            # Get tile coordinates and shapes
+        if ept_type == 'aoi':
+            # Get the tiles intersecting the AoI chunk by chunk
             logger.info("- Tiling of the empty tiles AoI")  
-            empty_tiles_4326_all_gdf = aoi_tiling(EPT_aoi_boundaries_df)
-            # Delete tiles outside of the AoI limits 
-            empty_tiles_4326_aoi_gdf = gpd.sjoin(empty_tiles_4326_all_gdf, EPT_aoi_4326_gdf, how='inner', lsuffix='ept_tiles', rsuffix='ept_aoi')
+            empty_tiles_chunks = aoi_tiles_generator(EPT_aoi_4326_gdf, zoom)
+            if ept_nb_tiles:
+                empty_tiles_4326_aoi_gdf = sample_tiles(empty_tiles_chunks, ept_nb_tiles, ept_seed)
+            else:
+                empty_tiles_chunks = list(empty_tiles_chunks)
+                if len(empty_tiles_chunks) > 0:
+                    empty_tiles_4326_aoi_gdf = pd.concat(empty_tiles_chunks, ignore_index=True)
+                else:
+                    empty_tiles_4326_aoi_gdf = gpd.GeoDataFrame(columns=['title', 'x', 'y', 'z', 'geometry'], geometry='geometry', crs='epsg:4326')
             # Attribute a year to empty tiles if necessary
             if 'year' in labels_4326_gdf.keys():
-                if isinstance(EPT_YEAR, int):
-                    empty_tiles_4326_aoi_gdf['year'] = int(EPT_YEAR)
+                if isinstance(ept_year, int):
+                    empty_tiles_4326_aoi_gdf['year'] = int(ept_year)
                 else:
-                    empty_tiles_4326_aoi_gdf['year'] = np.random.randint(low=EPT_YEAR[0], high=EPT_YEAR[1], size=(len(empty_tiles_4326_aoi_gdf)))
-        elif EPT_TYPE == 'shp':
-            if EPT_YEAR:
+                    # Random stream derived from the seed, independent of the one used for the sampling
+                    year_rng = np.random.default_rng(np.random.SeedSequence(ept_seed).spawn(1)[0])
+                    empty_tiles_4326_aoi_gdf['year'] = year_rng.integers(low=ept_year[0], high=ept_year[1], size=len(empty_tiles_4326_aoi_gdf))
+        elif ept_type == 'shp':
+            if ept_year:
                 logger.warning("A shapefile of selected empty tiles are provided. The year set for the empty tiles in the configuration file will be ignored")
-                EPT_YEAR = None
+                ept_year = None
             empty_tiles_4326_aoi_gdf = EPT_aoi_4326_gdf.copy()
+            empty_tiles_4326_aoi_gdf[['x', 'y', 'z']] = empty_tiles_4326_aoi_gdf.title.str.extract(r'x=(?P<x>\d*), y=(?P<y>\d*), z=(?P<z>\d*)')
 
         # Get all the tiles in one gdf 
         logger.info("- Concatenate label tiles and empty AoI tiles") 
@@ -249,9 +484,13 @@ if __name__ == "__main__":
 
     # - Remove useless columns, reset feature id and redefine it according to xyz format  
     logger.info('- Add tile IDs and reorganise the data set')
-    tiles_4326_all_gdf = tiles_4326_all_gdf[['geometry', 'title', 'year'] if 'year' in tiles_4326_all_gdf.keys() else ['geometry', 'title']].copy()
+    tile_columns = ['x', 'y', 'z', 'year'] if 'year' in tiles_4326_all_gdf.keys() else ['x', 'y', 'z']
+    tiles_4326_all_gdf = tiles_4326_all_gdf[['geometry', 'title'] + tile_columns].astype({col: int for col in tile_columns})
     tiles_4326_all_gdf.reset_index(drop=True, inplace=True)
-    tiles_4326_all_gdf = tiles_4326_all_gdf.apply(add_tile_id, axis=1)
+    tile_ids = tiles_4326_all_gdf.x.astype(str) + ', ' + tiles_4326_all_gdf.y.astype(str) + ', ' + tiles_4326_all_gdf.z.astype(str)
+    if 'year' in tiles_4326_all_gdf.keys():
+        tile_ids = tiles_4326_all_gdf.year.astype(str) + ', ' + tile_ids
+    tiles_4326_all_gdf['id'] = '(' + tile_ids + ')'
 
     # - Remove duplicated tiles
     tiles_4326_all_gdf.drop_duplicates(['id'], inplace=True)
@@ -264,18 +503,141 @@ if __name__ == "__main__":
     tiles_4326_gt_gdf.drop_duplicates(['id'], inplace=True)
     logger.info(f"- Number of tiles intersecting GT labels = {len(tiles_4326_gt_gdf)}")
 
-    if FP_SHPFILE:
+    if fp_shpfile:
         tiles_4326_fp_gdf = gpd.sjoin(tiles_4326_all_gdf, fp_labels_4326_gdf, how='inner', predicate='intersects')
         tiles_4326_fp_gdf.drop_duplicates(['id'], inplace=True)
         logger.info(f"- Number of tiles intersecting FP labels = {len(tiles_4326_fp_gdf)}")
 
     # Save tile shapefile
     logger.info("Export tiles to GeoJSON (EPSG:4326)...")  
-    tile_filepath = os.path.join(OUTPUT_DIR, 'tiles.geojson')
+    tile_filepath = os.path.join(output_dir, 'tiles.geojson')
     tiles_4326_all_gdf.to_file(tile_filepath, driver='GeoJSON')
     written_files.append(tile_filepath)  
     logger.success(f"{DONE_MSG} A file was written: {tile_filepath}")
 
+
+    return tiles_4326_all_gdf, written_files
+
+
+def sample_tiles(tiles_chunks, nb_tiles, seed=None):
+    """Draw a uniform sample of tiles from a stream of chunks without keeping the stream in memory.
+    Each tile gets a random priority and the tiles with the lowest priorities are kept from one chunk to the next.
+
+    Args:
+        tiles_chunks (iterable): chunks of tiles as GeoDataFrames
+        nb_tiles (int): number of tiles to sample
+        seed (int): seed of the random generator. Defaults to None.
+
+    Returns:
+        GeoDataFrame: sampled tiles, all the tiles if there are less than nb_tiles
+    """
+
+    rng = np.random.default_rng(seed)
+
+    sampled_tiles_gdf = gpd.GeoDataFrame()
+    nb_seen_tiles = 0
+    for tiles_gdf in tiles_chunks:
+        nb_seen_tiles += len(tiles_gdf)
+        tiles_gdf = tiles_gdf.assign(priority=rng.random(len(tiles_gdf)))
+        sampled_tiles_gdf = pd.concat([sampled_tiles_gdf, tiles_gdf], ignore_index=True).nsmallest(nb_tiles, 'priority')
+
+    logger.info(f"{len(sampled_tiles_gdf)} tiles sampled out of {nb_seen_tiles}")
+
+    return sampled_tiles_gdf.drop(columns='priority', errors='ignore').reset_index(drop=True)
+
+
+if __name__ == "__main__":
+
+    # Start chronometer
+    tic = time.time()
+    logger.info('Starting...')
+
+    # Argument and parameter specification
+    parser = argparse.ArgumentParser(description="The script prepares the ground truth dataset to be processed by the object-detector scripts")
+    parser.add_argument('config_file', type=str, help='Framework configuration file')
+    parser.add_argument('--dry-run', action='store_true', help='Estimate the number of tiles and the size of the outputs without writing them')
+    args = parser.parse_args()
+
+    logger.info(f"Using {args.config_file} as config file.")
+ 
+    with open(args.config_file) as fp:
+        full_cfg = yaml.load(fp, Loader=yaml.FullLoader)
+        cfg = full_cfg[os.path.basename(__file__)]
+
+    # Load input parameters
+    OUTPUT_DIR = cfg['output_folder']
+    SHPFILE = cfg['datasets']['shapefile']
+    FP_SHPFILE = cfg['datasets']['fp_shapefile'] if 'fp_shapefile' in cfg['datasets'].keys() else None
+    if 'empty_tiles' in cfg['datasets'].keys():
+        EPT_TYPE = cfg['datasets']['empty_tiles']['type']
+        EPT_SHPFILE = cfg['datasets']['empty_tiles']['shapefile']
+        EPT_YEAR = cfg['datasets']['empty_tiles']['year'] if 'year' in cfg['datasets']['empty_tiles'].keys() else None
+        EPT_NB_TILES = cfg['datasets']['empty_tiles']['nb_tiles'] if 'nb_tiles' in cfg['datasets']['empty_tiles'].keys() else None
+        EPT_SEED = cfg['datasets']['empty_tiles']['seed'] if 'seed' in cfg['datasets']['empty_tiles'].keys() else None
+    else:
+        EPT_SHPFILE = None
+        EPT_TYPE = None
+        EPT_YEAR = None
+        EPT_NB_TILES = None
+        EPT_SEED = None
+    CATEGORY = cfg['datasets']['category'] if 'category' in cfg['datasets'].keys() else None
+    CLASS_SELECTION = cfg['datasets']['class_selection'] if 'class_selection' in cfg['datasets'].keys() else None
+    CANTON_SELECTION = cfg['datasets']['canton_selection'] if 'canton_selection' in cfg['datasets'].keys() else None  
+    ZOOM_LEVELS = cfg['zoom_level'] if isinstance(cfg['zoom_level'], list) else [cfg['zoom_level']]
+    SPLIT_BY_CANTON = cfg['datasets']['split_by_canton'] if 'split_by_canton' in cfg['datasets'].keys() else False
+    N_JOBS = cfg['n_jobs'] if 'n_jobs' in cfg.keys() else 1
+
+    # One partition per zoom level and, if required, per canton
+    # The empty tiles are drawn from the whole AoI, whatever the cantons, so only the first partition of each zoom level gets them
+    canton_partitions = [[canton] for canton in CANTON_SELECTION] if SPLIT_BY_CANTON and CANTON_SELECTION else [CANTON_SELECTION]
+    partitions_dict = {}
+    for canton_selection in canton_partitions:
+        for zoom in ZOOM_LEVELS:
+            partition_name = f"{'_'.join(canton_selection)}_z{zoom}" if SPLIT_BY_CANTON and CANTON_SELECTION else f'z{zoom}'
+            partitions_dict[partition_name] = (canton_selection, zoom, canton_selection == canton_partitions[0])
+    
+    if args.dry_run:
+        tile_size = full_cfg['generate_tilesets.py']['tile_size'] if 'tile_size' in full_cfg.get('generate_tilesets.py', {}).keys() else 256
+        for partition_name, (canton_selection, zoom, with_empty_tiles) in partitions_dict.items():
+            logger.info(f"Partition {partition_name}")
+            dry_run(
+                SHPFILE, FP_SHPFILE, EPT_SHPFILE if with_empty_tiles else None, EPT_TYPE, EPT_NB_TILES, zoom, tile_size, 
+                CATEGORY, CLASS_SELECTION, canton_selection
+            )
+
+        toc = time.time()
+        logger.info(f"Nothing left to be done: exiting. Elapsed time: {(toc-tic):.2f} seconds")
+        sys.exit(0)
+
+    # Each partition is written in its own subfolder if there are several of them
+    logger.info(f"{len(partitions_dict)} partition(s) to prepare with {N_JOBS} job(s): {', '.join(partitions_dict.keys())}")
+    output_dirs_dict = {
+        partition_name: OUTPUT_DIR if len(partitions_dict) == 1 else os.path.join(OUTPUT_DIR, partition_name) 
+        for partition_name in partitions_dict.keys()
+    }
+    partition_results = Parallel(n_jobs=N_JOBS)(
+        delayed(prepare_tiles)(
+            output_dirs_dict[partition_name], zoom, SHPFILE, FP_SHPFILE, EPT_SHPFILE if with_empty_tiles else None, EPT_TYPE, EPT_YEAR, 
+            EPT_NB_TILES, EPT_SEED, CATEGORY, CLASS_SELECTION, canton_selection
+        ) 
+        for partition_name, (canton_selection, zoom, with_empty_tiles) in partitions_dict.items()
+    )
+    written_files = [written_file for _, partition_files in partition_results for written_file in partition_files]
+
+    # Index of the tiles of all the partitions
+    if len(partitions_dict) > 1:
+        logger.info("Export the index of the tiles of all the partitions to GeoJSON (EPSG:4326)...")
+        tiles_index_gdf = pd.concat(
+            [tiles_gdf.assign(partition=partition_name) for partition_name, (tiles_gdf, _) in zip(partitions_dict.keys(), partition_results)], 
+            ignore_index=True
+        )
+        # The label tiles along the canton borders belong to several partitions, they are indexed once in the first one
+        tiles_index_gdf.drop_duplicates(subset=['id', 'z'], inplace=True, ignore_index=True)
+        index_filepath = os.path.join(OUTPUT_DIR, 'tiles_index.geojson')
+        tiles_index_gdf.to_file(index_filepath, driver='GeoJSON')
+        written_files.append(index_filepath)
+        logger.success(f"{DONE_MSG} A file was written: {index_filepath}")
+
     print()
     logger.info("The following files were written. Let's check them out!")
     for written_file in written_files: